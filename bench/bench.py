@@ -0,0 +1,123 @@
+# Interpreter benchmarks
+#
+#   python3 bench/bench.py [name ...] [--engine ref|fast] [--repeat N]
+#                          [--save FILE] [--compare FILE]
+#
+# Runs every bench/*.runtime program (or the named ones) and reports
+# executed instructions per second, wall time and peak traced memory.
+# --save writes the results as a baseline JSON, --compare reports the
+# change against one and exits with 1 when a benchmark got slower than
+# --threshold.
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import runtime
+
+
+def run(compiled):
+    return runtime.VM(compiled).run()
+
+
+def run_fast(compiled):
+    prog, _, _ = compiled
+    runtime.FastEvaluator(runtime.Evaluator(), prog).run(runtime.new_env())
+
+
+def measure(path, repeat, memory=True, engine='ref'):
+    with open(path) as src_file:
+        compiled = runtime.compile_source(src_file.read())
+    run_engine = run_fast if engine == 'fast' else run
+    best = None
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        # the fast engine runs whole blocks, count with the reference one
+        count = run(compiled) if engine == 'fast' else None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(out):
+            start = time.perf_counter()
+            res = run_engine(compiled)
+            elapsed = time.perf_counter() - start
+        count = count or res
+        best = elapsed if best is None else min(best, elapsed)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        with contextlib.redirect_stdout(out):
+            run_engine(compiled)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return {
+        'instructions': count,
+        'seconds': best,
+        'ips': count / best,
+        'peak_kb': None if peak is None else peak // 1024,
+    }
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='runtime interpreter benchmarks')
+    arg_parser.add_argument('names', nargs='*', help='benchmarks to run, default all')
+    arg_parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark, best is kept')
+    arg_parser.add_argument('--engine', choices=('ref', 'fast'), default='ref',
+        help='interpreter engine to measure')
+    arg_parser.add_argument('--no-memory', action='store_true', help='skip the traced memory run')
+    arg_parser.add_argument('--save', metavar='FILE', help='save results as a baseline JSON')
+    arg_parser.add_argument('--compare', metavar='FILE', help='compare against a baseline JSON')
+    arg_parser.add_argument('--threshold', type=float, default=10,
+        help='percent of speed lost before it counts as a regression')
+    args = arg_parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(BENCH_DIR, '*.runtime')))
+    if args.names:
+        paths = [p for p in paths if os.path.basename(p)[:-len('.runtime')] in args.names]
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    print('{:<16} {:>10} {:>12} {:>10} {:>10} {:>9}'.format(
+        'benchmark', 'instrs', 'instrs/sec', 'wall ms', 'peak KB', 'change'))
+    results = {}
+    regressions = []
+    for path in paths:
+        name = os.path.basename(path)[:-len('.runtime')]
+        res = results[name] = measure(path, args.repeat, memory=not args.no_memory, engine=args.engine)
+        change = ''
+        if name in baseline:
+            # by wall time, the optimizer changes how many instructions a program takes
+            pct = (baseline[name]['seconds'] / res['seconds'] - 1) * 100
+            change = '{:+.1f}%'.format(pct)
+            if pct < -args.threshold:
+                regressions.append(name)
+                change += ' !'
+        print('{:<16} {:>10} {:>12,.0f} {:>10.1f} {:>10} {:>9}'.format(
+            name, res['instructions'], res['ips'], res['seconds'] * 1000,
+            '-' if res['peak_kb'] is None else res['peak_kb'], change))
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({
+                'python': sys.version.split()[0],
+                'engine': args.engine,
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': results,
+            }, baseline_file, indent=2)
+    if regressions:
+        print('regressed:', ', '.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+# OLED frame rate benchmark
+#
+#   python3 bench/oled_fps.py [--frames N] [--transfer]
+#
+# Renders the same text frames (7 rows of 21 characters, like the Moon OS
+# shell) to SH1106 page buffers with the PIL path Display.show used to take
+# (load the font, draw every row, getbuffer) and with the glyph atlas, and
+# reports frames per second. --transfer also sends each frame to the display.
+# Then times SH1106.getbuffer against the per-pixel loop it replaced, for
+# both image orientations.
+
+import argparse
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from PIL import Image, ImageDraw, ImageFont
+
+from oled import SH1106
+from oled.glyphs import FONT_PATH, GlyphAtlas
+
+ROWS = 7
+COLS = 21
+
+
+def frames(count, seed=0):
+    # a scrolling shell: each frame has one more line at the bottom
+    rnd = random.Random(seed)
+    chars = [chr(c) for c in range(32, 127)]
+    lines = [' ' * COLS] * ROWS
+    res = []
+    for _ in range(count):
+        lines = lines[1:] + [''.join(rnd.choice(chars) for _ in range(rnd.randrange(COLS + 1)))]
+        res.append(lines)
+    return res
+
+
+def render_pil(disp, rows):
+    image = Image.new('1', (disp.width, disp.height), 'WHITE')
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.truetype(FONT_PATH, 10)
+    for i, row in enumerate(rows):
+        draw.text((0, 9 * i), row, font=font, fill=0)
+    return disp.getbuffer(image)
+
+
+def getbuffer_loop(disp, image):
+    # SH1106.getbuffer before it packed pages with numpy
+    buf = [0xFF] * ((disp.width // 8) * disp.height)
+    image_monocolor = image.convert('1')
+    imwidth, imheight = image_monocolor.size
+    pixels = image_monocolor.load()
+    if imwidth == disp.width and imheight == disp.height:
+        for y in range(imheight):
+            for x in range(imwidth):
+                if pixels[x, y] == 0:
+                    buf[x + (y // 8) * disp.width] &= ~(1 << (y % 8))
+    elif imwidth == disp.height and imheight == disp.width:
+        for y in range(imheight):
+            for x in range(imwidth):
+                newx = y
+                newy = disp.height - x - 1
+                if pixels[x, y] == 0:
+                    buf[newx + (newy // 8) * disp.width] &= ~(1 << (y % 8))
+    return buf
+
+
+def images(disp, count, rotated=False, seed=0):
+    rnd = random.Random(seed)
+    size = (disp.height, disp.width) if rotated else (disp.width, disp.height)
+    return [Image.frombytes('1', size, bytes(rnd.getrandbits(8) for _ in range(size[0] * size[1] // 8)))
+            for _ in range(count)]
+
+
+def measure_ms(func, items):
+    start = time.perf_counter()
+    for item in items:
+        func(item)
+    return (time.perf_counter() - start) * 1000 / len(items)
+
+
+def measure(render, disp, rows_list, transfer):
+    start = time.perf_counter()
+    for rows in rows_list:
+        buf = render(rows)
+        if transfer:
+            disp.ShowImage(buf)
+    elapsed = time.perf_counter() - start
+    return len(rows_list) / elapsed
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='OLED frame rate benchmark')
+    arg_parser.add_argument('--frames', type=int, default=200, help='frames per renderer')
+    arg_parser.add_argument('--transfer', action='store_true',
+        help='send the frames to the display, not only render them')
+    args = arg_parser.parse_args()
+
+    disp = SH1106.SH1106()
+    if args.transfer:
+        disp.Init()
+    start = time.perf_counter()
+    atlas = GlyphAtlas(disp.width, disp.height)
+    atlas_ms = (time.perf_counter() - start) * 1000
+    rows_list = frames(args.frames)
+
+    print('{:<8} {:>10} {:>10}'.format('renderer', 'fps', 'ms/frame'))
+    results = {}
+    for name, render in (('pil', lambda rows: render_pil(disp, rows)), ('atlas', atlas.render)):
+        fps = results[name] = measure(render, disp, rows_list, args.transfer)
+        print('{:<8} {:>10.1f} {:>10.2f}'.format(name, fps, 1000 / fps))
+    print('atlas built in {:.1f} ms, {:.1f}x the pil frame rate'.format(
+        atlas_ms, results['atlas'] / results['pil']))
+    print()
+    print('{:<10} {:>10} {:>10} {:>8}'.format('getbuffer', 'loop ms', 'numpy ms', 'speedup'))
+    count = max(1, args.frames // 10)
+    for rotated in (False, True):
+        image_list = images(disp, count, rotated)
+        loop_ms = measure_ms(lambda image: getbuffer_loop(disp, image), image_list)
+        numpy_ms = measure_ms(disp.getbuffer, image_list)
+        print('{:<10} {:>10.3f} {:>10.3f} {:>7.0f}x'.format(
+            'rotated' if rotated else 'normal', loop_ms, numpy_ms, loop_ms / numpy_ms))
+    if args.transfer:
+        disp.clear()
+
+
+if __name__ == '__main__':
+    main()
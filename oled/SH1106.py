@@ -9,6 +9,9 @@ Device_I2C = config.Device_I2C
 LCD_WIDTH   = 128 #LCD width
 LCD_HEIGHT  = 64  #LCD height
 
+# buffer bits are cleared for ink, the display lights set bits
+INVERT = bytes(0xFF - i for i in range(256))
+
 class SH1106(object):
     def __init__(self):
         self.width = LCD_WIDTH
@@ -28,9 +31,21 @@ class SH1106(object):
         else:
             config.i2c_writebyte(0x00, cmd)
 
-    # def data(self, val):
-        # GPIO.output(self._dc, GPIO.HIGH)
-        # config.spi_writebyte([val])
+    def commands(self, cmds):
+        """Write several commands in one transfer"""
+        if(self.Device == Device_SPI):
+            GPIO.output(self._dc, GPIO.LOW)
+            config.spi_writebytes(cmds)
+        else:
+            config.i2c_writeblock(0x00, cmds)
+
+    def data(self, buf):
+        """Write display data in bulk"""
+        if(self.Device == Device_SPI):
+            GPIO.output(self._dc, GPIO.HIGH)
+            config.spi_writebytes(buf)
+        else:
+            config.i2c_writeblock(0x40, buf)
 
     def Init(self):
         if (config.module_init() != 0):
@@ -75,31 +90,22 @@ class SH1106(object):
         time.sleep(0.1)
     
     def getbuffer(self, image):
-        # print "bufsiz = ",(self.width/8) * self.height
-        buf = [0xFF] * ((self.width//8) * self.height)
+        """Pack a 1-bit image into display pages, bit y % 8 of byte
+        x + (y // 8) * width cleared for ink"""
         image_monocolor = image.convert('1')
         imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        # print "imwidth = %d, imheight = %d",imwidth,imheight
+        # True for white pixels, rows by y
+        pixels = np.asarray(image_monocolor, dtype=bool)
         if(imwidth == self.width and imheight == self.height):
-            # print ("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if pixels[x, y] == 0:
-                        buf[x + (y // 8) * self.width] &= ~(1 << (y % 8))
-                        # print x,y,x + (y * self.width)/8,buf[(x + y * self.width) / 8]
-                        
+            pass
         elif(imwidth == self.height and imheight == self.width):
-            # print ("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        buf[(newx + (newy // 8 )*self.width) ] &= ~(1 << (y % 8))
-        return buf
-    
+            # rotated a quarter turn: x = y, y = height - x - 1
+            pixels = np.rot90(pixels)
+        else:
+            return bytearray(b'\xff' * ((self.width//8) * self.height))
+        # (page, bit, x), packed along the vertical axis
+        pages = pixels.reshape(self.height // 8, 8, self.width)
+        return bytearray(np.packbits(pages, axis=1, bitorder='little').tobytes())
     
     # def ShowImage(self,Image):
         # self.SetWindows()
@@ -107,31 +113,17 @@ class SH1106(object):
         # for i in range(0,self.width * self.height/8):
             # config.spi_writebyte([~Image[i]])
             
-    def ShowImage(self, pBuf):
-        for page in range(0,8):
-            # set page address #
-            self.command(0xB0 + page);
-            # set low column address #
-            self.command(0x02); 
-            # set high column address #
-            self.command(0x10); 
-            # write data #
-            # time.sleep(0.01)
-            if(self.Device == Device_SPI):
-                GPIO.output(self._dc, GPIO.HIGH);
-            for i in range(0,self.width):#for(int i=0;i<self.width; i++)
-                if(self.Device == Device_SPI):
-                    config.spi_writebyte([~pBuf[i+self.width*page]]); 
-                else :
-                    config.i2c_writebyte(0x40, ~pBuf[i+self.width*page])
-                    
-                    
-
-	
+    def ShowImage(self, pBuf, pages=range(0,8)):
+        buf = bytes(pBuf).translate(INVERT)
+        for page in pages:
+            # set page address, low and high column address
+            self.commands([0xB0 + page, 0x02, 0x10])
+            # write the page
+            self.data(buf[self.width * page:self.width * (page + 1)])
 
     def clear(self):
         """Clear contents of image buffer"""
-        _buffer = [0xff]*(self.width * self.height//8)
+        _buffer = b'\xff' * (self.width * self.height//8)
         self.ShowImage(_buffer) 
             #print "%d",_buffer[i:i+4096]
     
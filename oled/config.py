@@ -43,6 +43,10 @@ BL_PIN          = 18
 Device_SPI = 1
 Device_I2C = 0
 
+# Bulk transfer limits
+SPI_CHUNK       = 4096  # spidev bufsiz
+I2C_BLOCK       = 32    # SMBus block write
+
 if(Device_SPI == 1):
     Device = Device_SPI
     spi = spidev.SpiDev(0, 0)
@@ -66,6 +70,16 @@ def spi_writebyte(data):
 
 def i2c_writebyte(reg, value):
     bus.write_byte_data(address, reg, value)
+
+def spi_writebytes(data):
+    # one transfer per SPI_CHUNK bytes
+    for i in range(0, len(data), SPI_CHUNK):
+        spi.writebytes(list(data[i:i + SPI_CHUNK]))
+
+def i2c_writeblock(reg, data):
+    # one block write per I2C_BLOCK bytes, all with the same control byte
+    for i in range(0, len(data), I2C_BLOCK):
+        bus.write_i2c_block_data(address, reg, list(data[i:i + I2C_BLOCK]))
     
     # time.sleep(0.01)
 def module_init():
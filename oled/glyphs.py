@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding:utf-8 -*-
+
+import os
+from PIL import Image, ImageDraw, ImageFont
+
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'DejaVuSansMono.ttf')
+
+class GlyphAtlas:
+    # Text renderer for the SH1106 page buffer. Each glyph is drawn with PIL
+    # once and kept as its pixel columns (bit y set for ink at y), frames are
+    # composed from those columns without PIL. The buffer has the format of
+    # SH1106.getbuffer: 8 pages of width bytes, bit y % 8 of byte
+    # x + (y // 8) * width cleared for ink.
+    def __init__(self, width=128, height=64, font_path=FONT_PATH, size=10, row_height=9):
+        self.width = width
+        self.height = height
+        self.row_height = row_height
+        self.font = ImageFont.truetype(font_path, size)
+        self.advance = int(self.font.getlength(' '))
+        ascent, descent = self.font.getmetrics()
+        # glyphs can be wider than the advance and taller than a row, their
+        # ink overlaps the next cell like it does when PIL draws the string
+        self.cell = (self.advance * 2, ascent + descent)
+        self.glyphs = {}
+        for c in range(32, 127):
+            self.glyph(chr(c))
+
+    def glyph(self, c):
+        # -> [(x offset, column bits)] of the ink of c, drawn on first use
+        glyph = self.glyphs.get(c)
+        if glyph is None:
+            image = Image.new('1', self.cell, 'WHITE')
+            ImageDraw.Draw(image).text((0, 0), c, font=self.font, fill=0)
+            pixels = image.load()
+            glyph = []
+            for x in range(self.cell[0]):
+                bits = 0
+                for y in range(self.cell[1]):
+                    if pixels[x, y] == 0:
+                        bits |= 1 << y
+                if bits:
+                    glyph.append((x, bits))
+            self.glyphs[c] = glyph
+        return glyph
+
+    def row_pages(self, i):
+        # -> the pages the ink of text row i can reach
+        top = self.row_height * i
+        bottom = min(top + self.cell[1], self.height) - 1
+        return range(top // 8, bottom // 8 + 1)
+
+    def columns(self, rows, indexes=None):
+        # -> pixel columns of the text rows (or the rows at indexes), bit y
+        # set for ink at y
+        columns = [0] * self.width
+        mask = (1 << self.height) - 1
+        if indexes is None:
+            indexes = range(len(rows))
+        for i in indexes:
+            row = rows[i]
+            shift = self.row_height * i
+            if shift >= self.height:
+                break
+            for j, c in enumerate(row):
+                if c == ' ':
+                    continue
+                x0 = self.advance * j
+                for dx, bits in self.glyph(c):
+                    x = x0 + dx
+                    if x < self.width:
+                        columns[x] |= (bits << shift) & mask
+        return columns
+
+    def render(self, rows, pages=None, buf=None):
+        # -> page buffer of the text rows, with pages only those pages of
+        # buf are rendered
+        if pages is None:
+            pages = range(self.height // 8)
+            indexes = None
+        else:
+            indexes = [i for i in range(len(rows)) if not pages.isdisjoint(self.row_pages(i))]
+        columns = self.columns(rows, indexes)
+        if buf is None:
+            buf = bytearray(self.width * self.height // 8)
+        for page in pages:
+            offset = page * self.width
+            shift = page * 8
+            for x, bits in enumerate(columns):
+                buf[offset + x] = ~(bits >> shift) & 0xFF
+        return buf
@@ -2,34 +2,87 @@
 # -*- coding:utf-8 -*-
 
 from . import SH1106
+from .glyphs import GlyphAtlas
+import threading
 import time
-from PIL import Image,ImageDraw,ImageFont
+
+FPS = 30  # frame rate cap of the display writer
 
 class Display:
-    def __init__(self):
+    # print() only updates the text buffer, a writer thread sends frames at
+    # most fps times per second, so text printed between two frames is sent
+    # once. flush() sends what is left right away.
+    def __init__(self, fps=FPS):
         self.width = 21
         self.height = 7
 
         self.buffer = [' ' * self.width] * self.height
         self.disp = SH1106.SH1106()
+        self.atlas = GlyphAtlas(self.disp.width, self.disp.height)
         self.disp.Init()
         self.cur_row = 0
         self.cur_col = 0
+        # page buffer on the display, text rows changed since it was sent
+        self.frame = bytearray(b'\xff' * (self.disp.width * self.disp.height // 8))
+        self.dirty = set()
+        # lock: buffer, cursor and dirty; bus: frame and the display
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.bus = threading.Lock()
 
         self.disp.clear()
+        self.interval = 1.0 / fps
+        self.writer = threading.Thread(target=self._write, name='oled-writer', daemon=True)
+        self.writer.start()
+
+    def _write(self):
+        while True:
+            with self.lock:
+                while not self.dirty:
+                    self.changed.wait()
+            start = time.monotonic()
+            self.show()
+            time.sleep(max(0, start + self.interval - time.monotonic()))
 
     def show(self):
-        image1 = Image.new('1', (self.disp.width, self.disp.height), "WHITE")
-        draw = ImageDraw.Draw(image1)
-        font_d = ImageFont.truetype('DejaVuSansMono.ttf', 10)
-        for i in range(self.height):
-            draw.text((0, 9 * i), self.buffer[i], font=font_d, fill=0)
-        self.disp.ShowImage(self.disp.getbuffer(image1))
+        # render the pages of the changed rows, send the ones that changed
+        with self.bus:
+            with self.lock:
+                if not self.dirty:
+                    return
+                rows = list(self.buffer)
+                pages = set()
+                for i in self.dirty:
+                    pages.update(self.atlas.row_pages(i))
+                self.dirty.clear()
+            frame = self.atlas.render(rows, pages, bytearray(self.frame))
+            width = self.disp.width
+            changed = [page for page in sorted(pages)
+                       if frame[page * width:(page + 1) * width] != self.frame[page * width:(page + 1) * width]]
+            self.frame = frame
+            if changed:
+                self.disp.ShowImage(frame, changed)
+
+    def flush(self):
+        # send the text printed so far, waits for a frame being sent
+        self.show()
 
     def clear(self):
-        self.disp.clear()
+        with self.bus:
+            self.disp.clear()
+            # the next show sends every row again
+            self.frame = bytearray(b'\xff' * len(self.frame))
+            with self.lock:
+                self.dirty.update(range(self.height))
+                self.changed.notify()
 
     def print(self, text, end=None):
+        with self.lock:
+            self._print(text, end)
+            if self.dirty:
+                self.changed.notify()
+
+    def _print(self, text, end):
         text += '\n' if end is None else end
         for c in text:
             if c == '\n':
@@ -44,14 +97,17 @@ class Display:
                 if self.cur_row == len(self.buffer):
                     self.buffer.append(' ' * self.width)
                 line = self.buffer[self.cur_row]
-                self.buffer[self.cur_row] = line[:self.cur_col] + c + line[self.cur_col+1:]
+                if line[self.cur_col] != c:
+                    self.buffer[self.cur_row] = line[:self.cur_col] + c + line[self.cur_col+1:]
+                    self.dirty.add(self.cur_row)
                 self.cur_col += 1
         if self.cur_row >= self.height:
             cur_buffer_height = len(self.buffer)
             self.buffer = self.buffer[cur_buffer_height - self.height:]
             self.cur_row = self.height - 1
+            # scrolled, every row moved
+            self.dirty.update(range(self.height))
         #self._log_buffer()
-        self.show()
 
     def _log_buffer(self):
         print('-----')
@@ -59,6 +115,16 @@ class Display:
             print(row + '|')
 
 
+_display = None
+
+def shared():
+    # the display of this process, all evaluators print to it
+    global _display
+    if _display is None:
+        _display = Display()
+    return _display
+
+
 '''
 try:
     disp = SH1106.SH1106()
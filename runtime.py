@@ -1,9 +1,22 @@
+import argparse
+import collections
+import contextlib
 import datetime
+import functools
+import hashlib
+import heapq
+import io
 import json
+import os
+import pickle
 import random
 import sys
 import time
 
+# bump when the compiled program format changes, invalidates .rtc caches
+VERSION = '1.3'
+CACHE_EXT = '.rtc'
+
 class Parser:
     def parse(self, src):
         program = []
@@ -40,6 +53,61 @@ class Parser:
             program.append(line_tokens)
         return (program, labels, funcs)
 
+    def scan(self, src):
+        # parse() for lazy mode: function bodies are left out (empty lines)
+        # and found by their def and end lines only, see parse_body()
+        # -> (program, labels, funcs, bodies) or None if def and end don't pair up
+        program = []
+        labels = {
+            'global': {},
+            'function': {}
+        }
+        funcs = {}
+        bodies = {}  # function -> (def line, end line)
+
+        lines = src.split('\n')
+        _current_func = None
+        for ln, l in enumerate(lines):
+            l = l.strip()
+            if _current_func is not None:
+                if l.startswith('def '):
+                    return None
+                if l == 'end':
+                    bodies[_current_func] = (funcs[_current_func], ln)
+                    _current_func = None
+                    program.append(self._tokenize(l))
+                else:
+                    program.append([])
+                continue
+            if l == '' or l.startswith('/'):
+                program.append([])
+                continue
+            if l[0] == '#':
+                labels['global'][l[1:].strip()] = ln
+            if l.startswith('def '):
+                func_name = l[3:].strip().split(' ')[0]
+                funcs[func_name] = ln
+                labels[func_name] = {}
+                _current_func = func_name
+            program.append(self._tokenize(l))
+        if _current_func is not None:
+            return None
+        return (program, labels, funcs, bodies)
+
+    def parse_body(self, lines, start, end, labels, func_name):
+        # tokens of the lines of a function from def to end, as parse()
+        # would give them, and its labels
+        program = []
+        for ln in range(start, end + 1):
+            l = lines[ln].strip()
+            if l == '' or l.startswith('/'):
+                program.append([])
+                continue
+            if l[0] == '#':
+                labels[func_name][l[1:].strip()] = ln
+            program.append(self._tokenize(l))
+        return program
+
     def _tokenize(self, line):
         tokens = []
         current = ''
@@ -87,51 +155,797 @@ class Parser:
             tokens.append(current)
         return tokens
 
+# operand kinds
+CONST = 0     # int, str or nil constant
+GLOBAL = 1    # global variable
+LOCAL = 2     # function scoped variable: ret, _name or arg index, (LOCAL, slot, name)
+NEW_LIST = 3  # []
+NEW_MAP = 4   # {}
+
+# ret always takes the first slot of a frame
+RET = (LOCAL, 0, 'ret')
+
+_LOOP_END = object()
+_UNSET = object()
+
+class Frame:
+    __slots__ = ('func', 'pc', 'slots', 'loops')
+
+    def __init__(self, func, pc, slots):
+        self.func = func
+        self.pc = pc
+        # locals and args by slot index, _UNSET until assigned
+        self.slots = slots
+        # for loop states by loop head, created on demand
+        self.loops = None
+
+class Code(list):
+    # compiled instructions, lines[pc] is the source line index of instruction pc
+    def __init__(self, instructions, lines=None):
+        super().__init__(instructions)
+        self.lines = list(range(len(self))) if lines is None else lines
+
+# operand index of the jump target of each command: the pc is set to the
+# target and the instruction after it runs next
+JUMP_TARGET = {
+    'jmp': 1, 'jeq': 3, 'jne': 3, 'jlt': 3, 'jgt': 3,
+    'ife': -1, 'ifg': -1, 'els': -1, 'for': -1, 'nxt': -1, 'def': -1,
+    # superinstructions made by the Optimizer
+    'jeq/k': 3, 'jne/k': 3, 'jlt/k': 3, 'jgt/k': 3, 'ife/k': -1, 'ifg/k': -1,
+    'add/jmp': -1,
+}
+
+class CompileError(Exception):
+    def __init__(self, errors):
+        super().__init__('\n'.join(errors))
+        self.errors = errors
+
+class Compiler:
+    # operand layout of each command
+    #   e: expression   v: variable to assign   r: $variable to update
+    #   n: name (label or function)   *: expressions for the rest
+    # commands not listed here (extensions) take expressions only
+    SIGNATURES = {
+        'let': 've', 'prt': 'ee', 'inp': 'v', 'prs': 've',
+        'jmp': 'n', 'jeq': 'een', 'jne': 'een', 'jlt': 'een', 'jgt': 'een',
+        'ife': 'ee', 'ifg': 'ee', 'els': '', 'fin': '',
+        'add': 'vee', 'sub': 'vee', 'mul': 'vee', 'mod': 'vee', 'div': 'vee',
+        'int': 've', 'str': 've', 'typ': 've',
+        'psh': 'r*', 'pop': 'rv', 'pol': 'rv', 'len': 'rv',
+        'put': 'ree', 'get': 'rev', 'key': 'rv', 'del': 're',
+        'rnd': 'vee', 'tim': 've', 'slp': 'e',
+        'def': 'n', 'ret': 'e', 'end': '', 'cal': 'n*',
+        'for': 've', 'nxt': '',
+        'spn': 'n*', 'jon': 'e', 'chn': 've', 'snd': 'ee', 'rcv': 'ev',
+        'snp': 'e',
+    }
+    LABEL_OPERAND = {'jmp': 1, 'jeq': 3, 'jne': 3, 'jlt': 3, 'jgt': 3}
+    BLOCK_OPENERS = {'fin': ('ife', 'ifg'), 'nxt': ('for',), 'end': ('def',)}
+
+    def compile(self, program, labels, funcs, base=0, functions=None):
+        # program: token lines from line base on
+        # functions: already known ones, (def line, None, None) for functions
+        # whose bodies are compiled later (lazy mode), their cal is linked then
+        # and their def lines don't start a function here
+        self.errors = []
+        self.base = base
+        # compiled functions: name -> (def line, number of slots, arg slots)
+        self.functions = {} if functions is None else functions
+        self.func = None
+        code = []
+        for ln, ts in enumerate(program, base):
+            if ts and ts[0] == 'def' and len(ts) > 1 and self.functions.get(ts[1], (0, 0))[1] is not None:
+                self._begin_function(ts[1], ln)
+            if ts and ts[0] == 'snp' and (len(ts) != 2 or ts[1][0] not in '$\''):
+                # a bare word is most likely a mistyped spn
+                self._error('snp needs a quoted path or a variable', ln)
+            code.append(self._compile_line(ts))
+            if ts and ts[0] == 'end' and self.func is not None:
+                self._end_function()
+        code = self._resolve_labels(code, labels)
+        code = self._link_blocks(code)
+        if self.errors:
+            raise CompileError(self.errors)
+        return Code(code, list(range(base, base + len(code))))
+
+    def _begin_function(self, name, ln):
+        self.func = (name, ln)
+        self.slots = {'ret': 0}
+
+    def _end_function(self):
+        name, ln = self.func
+        # args are copied into consecutive slots up to the highest one used
+        max_arg = max([int(n) for n in self.slots if n.isdigit()], default=-1)
+        arg_slots = tuple(self.slots.setdefault(str(i), len(self.slots)) for i in range(max_arg + 1))
+        self.functions[name] = (ln, len(self.slots), arg_slots)
+        self.func = None
+
+    def _resolve_labels(self, code, labels):
+        # replace label names of jumps with the label line in the same scope,
+        # and function names of cal with (name, def line, number of slots, arg slots)
+        resolved = []
+        scope = 'global'
+        for ln, ins in enumerate(code, self.base):
+            cmd = ins[0] if ins else None
+            if cmd == 'def':
+                scope = ins[1]
+            elif cmd == 'end':
+                scope = 'global'
+            elif cmd in ('cal', 'spn'):
+                if ins[1] in self.functions:
+                    ins = (cmd, (ins[1],) + self.functions[ins[1]]) + ins[2:]
+                else:
+                    self._error('invalid function ' + ins[1], ln)
+            elif cmd in self.LABEL_OPERAND:
+                i = self.LABEL_OPERAND[cmd]
+                name = ins[i] if len(ins) > i else ''
+                if name in labels[scope]:
+                    ins = ins[:i] + (labels[scope][name],) + ins[i+1:]
+                else:
+                    self._error('invalid label in scope ' + name, ln)
+            resolved.append(ins)
+        return resolved
+
+    def _link_blocks(self, code):
+        # append the jump target of each block command:
+        #   ife/ifg -> els or fin   els -> fin   for -> nxt   nxt -> for - 1
+        #   def -> end
+        targets = {}
+        blocks = []  # open blocks: [cmd, line, els line]
+        for ln, ins in enumerate(code, self.base):
+            cmd = ins[0] if ins else None
+            if cmd in ('ife', 'ifg', 'for'):
+                blocks.append([cmd, ln, None])
+            elif cmd == 'def':
+                if blocks:
+                    self._unclosed(blocks)
+                    blocks = []
+                blocks.append([cmd, ln, None])
+            elif cmd == 'els':
+                if not blocks or blocks[-1][0] not in ('ife', 'ifg') or blocks[-1][2] is not None:
+                    self._error('unexpected els', ln)
+                    continue
+                targets[blocks[-1][1]] = ln
+                blocks[-1][2] = ln
+            elif cmd in ('fin', 'nxt', 'end'):
+                opener = self.BLOCK_OPENERS[cmd]
+                if cmd == 'end':
+                    while blocks and blocks[-1][0] != 'def':
+                        self._unclosed([blocks.pop()])
+                if not blocks or blocks[-1][0] not in opener:
+                    self._error('unexpected ' + cmd, ln)
+                    continue
+                _, head, els = blocks.pop()
+                if cmd == 'fin' and els is not None:
+                    targets[els] = ln
+                else:
+                    targets[head] = ln
+                if cmd == 'nxt':
+                    targets[ln] = head - 1
+        self._unclosed(blocks)
+
+        return [ins + (targets[ln],) if ln in targets else ins for ln, ins in enumerate(code, self.base)]
+
+    def _unclosed(self, blocks):
+        for cmd, ln, _ in blocks:
+            self._error('unclosed ' + cmd, ln)
+
+    def _error(self, msg, ln):
+        self.errors.append('ERR {} line: {}'.format(msg, ln + 1))
+
+    def _compile_line(self, ts):
+        if not ts or ts[0][0] == '#':
+            return ()
+        cmd = ts[0]
+        signature = self.SIGNATURES.get(cmd, '*')
+        ins = [cmd]
+        for i, token in enumerate(ts[1:]):
+            kind = signature[min(i, len(signature) - 1)] if signature else 'e'
+            if kind == 'v':
+                ins.append(self.variable(token))
+            elif kind == 'r':
+                # remove $
+                ins.append(self.variable(token[1:], read=True))
+            elif kind == 'n':
+                ins.append(token)
+            else:
+                ins.append(self.operand(token))
+        return tuple(ins)
+
+    def variable(self, name, read=False):
+        # args can be read but never assigned in function scope,
+        # outside functions every variable is global
+        if self.func is not None and (name == 'ret' or name[0] == '_' or (read and name.isdigit())):
+            return (LOCAL, self.slots.setdefault(name, len(self.slots)), name)
+        return (GLOBAL, name)
+
+    def operand(self, exp):
+        if exp[0] == '$':
+            var_name = exp[1:]
+            if var_name == 'nil':
+                return (CONST, None)
+            return self.variable(var_name, read=True)
+        elif exp == '[]':
+            return (NEW_LIST, None)
+        elif exp == '{}':
+            return (NEW_MAP, None)
+        elif exp[0] == '\'' and exp[-1] == '\'':
+            return (CONST, exp[1:-1])
+        try:
+            return (CONST, int(exp))
+        except ValueError:
+            return (CONST, exp)
+
+class Optimizer:
+    # Peephole pass over compiled code, run before execution:
+    #   - commands on constants only are folded, add x 1 2 -> let x 3
+    #   - let and compares with a constant operand become /k superinstructions
+    #   - blank, comment, label and fin lines are dropped
+    #   - add followed by jmp (loop counters) becomes add/jmp
+    # Jump targets are moved to the new positions and Code.lines keeps the
+    # source line of every instruction for error messages and the profiler.
+
+    FOLDABLE = ('add', 'sub', 'mul', 'mod', 'div', 'int', 'str', 'typ')
+    BRANCHES = ('jeq', 'jne', 'jlt', 'jgt', 'ife', 'ifg')
+
+    def __init__(self):
+        # folding runs the built-in commands on a scratch env
+        self.evaluator = Evaluator()
+
+    def optimize(self, code, compact=True):
+        # compact=False keeps every instruction at its place (lazy mode):
+        # nothing is dropped and the jmp of add/jmp stays behind it
+        code = Code([self._fold(ins) for ins in code], code.lines)
+        if not compact:
+            return self._fuse(code, compact)
+        code = self._compact(code, {pc for pc, ins in enumerate(code) if not ins or ins[0] == 'fin'})
+        return self._fuse(code)
+
+    def _fold(self, ins):
+        if not ins:
+            return ins
+        cmd = ins[0]
+        if cmd in self.FOLDABLE and len(ins) > 2 and all(exp[0] == CONST for exp in ins[2:]):
+            val = self._run(ins)
+            if val is not _UNSET:
+                return ('let/k', ins[1], (CONST, val))
+        elif cmd == 'let' and len(ins) > 2 and ins[2][0] == CONST:
+            return ('let/k',) + ins[1:]
+        elif cmd in self.BRANCHES and len(ins) > 3 and ins[2][0] == CONST:
+            if ins[1][0] == CONST:
+                return self._branch(ins)
+            if cmd == 'jgt':
+                try:
+                    ins = ins[:2] + ((CONST, int(ins[2][1])),) + ins[3:]
+                except (TypeError, ValueError):
+                    return ins
+            return (cmd + '/k',) + ins[1:]
+        return ins
+
+    def _scratch_env(self, var=None):
+        env = new_env()
+        if var is not None and var[0] == LOCAL:
+            env['stack'].append(Frame(None, 0, [_UNSET] * (var[1] + 1)))
+        return env
+
+    def _run(self, ins):
+        # value assigned by a command on constants, _UNSET when it can't be folded
+        env = self._scratch_env(ins[1])
+        try:
+            self.evaluator.dispatch[ins[0]](ins, env, None, None, None)
+        except Exception:
+            # errors are left for run time
+            return _UNSET
+        val = self.evaluator._get_var_val(env, ins[1])
+        return val if val is None or type(val) in (int, str) else _UNSET
+
+    def _branch(self, ins):
+        # compare of two constants: jmp when taken, dropped otherwise
+        env = self._scratch_env()
+        env['pc'] = None
+        try:
+            self.evaluator.dispatch[ins[0]](ins, env, None, None, None)
+        except Exception:
+            return ins
+        return () if env['pc'] is None else ('jmp', env['pc'])
+
+    def _targets(self, ins):
+        # jump targets of an instruction, cal jumps to the function entry
+        if not ins:
+            return ()
+        if ins[0] in ('cal', 'spn'):
+            return (ins[1][1],)
+        if ins[0] in JUMP_TARGET:
+            return (ins[JUMP_TARGET[ins[0]]],)
+        return ()
+
+    def _retarget(self, ins, new_pc):
+        cmd = ins[0]
+        if cmd in ('cal', 'spn'):
+            name, func_pc, slot_count, arg_slots = ins[1]
+            return (cmd, (name, new_pc(func_pc), slot_count, arg_slots)) + ins[2:]
+        if cmd in JUMP_TARGET:
+            i = JUMP_TARGET[cmd] % len(ins)
+            return ins[:i] + (new_pc(ins[i]),) + ins[i+1:]
+        return ins
+
+    def _compact(self, code, dropped):
+        # remove the dropped instructions, a jump to one of them lands on the
+        # next kept instruction
+        first_kept = []  # old pc -> new pc of the first kept instruction from there
+        kept = 0
+        for pc in range(len(code)):
+            first_kept.append(kept)
+            if pc not in dropped:
+                kept += 1
+        first_kept.append(kept)
+
+        def new_pc(target):
+            return first_kept[target + 1] - 1
+
+        instructions = [self._retarget(ins, new_pc) for pc, ins in enumerate(code) if pc not in dropped]
+        return Code(instructions, [ln for pc, ln in enumerate(code.lines) if pc not in dropped])
+
+    def _fuse(self, code, compact=True):
+        # pairs are only fused when nothing jumps or returns to the second one
+        if not compact:
+            fused = [('add/jmp',) + ins[1:] + nxt[1:]
+                     if ins and nxt and ins[0] == 'add' and len(ins) == 4 and nxt[0] == 'jmp' and len(nxt) == 2
+                     else ins
+                     for ins, nxt in zip(code, code[1:] + [()])]
+            return Code(fused, code.lines)
+        entries = set()
+        for pc, ins in enumerate(code):
+            entries.update(target + 1 for target in self._targets(ins))
+            if ins[0] == 'cal':
+                entries.add(pc + 1)
+        fused = list(code)
+        dropped = set()
+        for pc in range(len(code) - 1):
+            ins, nxt = code[pc], code[pc + 1]
+            if (ins[0] == 'add' and len(ins) == 4 and nxt[0] == 'jmp' and len(nxt) == 2
+                    and pc + 1 not in entries):
+                fused[pc] = ('add/jmp',) + ins[1:] + nxt[1:]
+                dropped.add(pc + 1)
+        return self._compact(Code(fused, code.lines), dropped)
+
+class LazyCode(Code):
+    # Code of a program parsed with Parser.scan(): function bodies stay
+    # source text until the first cal or spn of the function, then they are
+    # tokenized, compiled and optimized into their place. Functions not
+    # compiled yet have None slots in the cal operand, link() fills them in.
+    def __init__(self, code, src_lines, labels, bodies, functions, optimize=True):
+        super().__init__(code, code.lines)
+        self.src_lines = src_lines
+        self.labels = labels
+        self.bodies = bodies  # function -> (def line, end line), not compiled yet
+        self.functions = functions
+        self.optimize = optimize
+
+    def function(self, name):
+        # -> (def line, number of slots, arg slots), compiling the function first
+        if name in self.bodies:
+            start, end = self.bodies.pop(name)
+            tokens = Parser().parse_body(self.src_lines, start, end, self.labels, name)
+            # no longer a lazy function: the compiler registers it at its end
+            del self.functions[name]
+            code = Compiler().compile(tokens, self.labels, None, start, self.functions)
+            if self.optimize:
+                code = Optimizer().optimize(code, compact=False)
+            self[start:end + 1] = code
+        return self.functions[name]
+
+    def link(self, pc):
+        # the cal or spn at pc with its function compiled
+        ins = self[pc]
+        ins = (ins[0], (ins[1][0],) + self.function(ins[1][0])) + ins[2:]
+        self[pc] = ins
+        return ins
+
+class QueueList(collections.deque):
+    # list that has been consumed with pol, O(1) at both ends. pol takes
+    # from it in place only while it is private to its variable: once stored
+    # somewhere else (let, args, ret, psh or put into a container, snd) it
+    # may be aliased and the next pol rebinds the variable to a copy, like
+    # pol of a list does
+    shared = False
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+class Text:
+    # mutable string, used once a string is changed in place by psh/pop/put/pol
+    # reading it as a value gives back a plain str. The value is
+    # string[head:end] followed by the pieces pushed to tail, so pol and pop
+    # move an offset and psh keeps the piece; a read then costs one slice or
+    # join, never more than the str slicing these ops used to do. A run of
+    # puts edits a list of the chars instead, see put.
+    __slots__ = ('string', 'head', 'end', 'tail', 'size', 'chars', 'edits', 'cache')
+
+    def __init__(self, string):
+        self._set(string)
+
+    def _set(self, string):
+        self.string = string
+        self.head = 0
+        self.end = len(string)
+        self.tail = []
+        self.size = 0
+        self.chars = None
+        self.edits = 0
+        self.cache = string
+
+    def __len__(self):
+        if self.chars is not None:
+            return len(self.chars)
+        return self.end - self.head + self.size
+
+    def __getitem__(self, index):
+        if self.chars is not None:
+            return self.chars[index]
+        if index < 0:
+            index += len(self)
+        if index < 0:
+            raise IndexError(index)
+        if index < self.end - self.head:
+            return self.string[self.head + index]
+        return str(self)[index]
+
+    def __str__(self):
+        if self.cache is None:
+            if self.chars is not None:
+                string = ''.join(self.chars)
+            else:
+                string = self.string[self.head:self.end] + ''.join(self.tail)
+            self._set(string)
+        return self.cache
+
+    def push(self, string):
+        if type(string) != str:
+            raise TypeError('can only concatenate str (not "{}") to str'.format(type(string).__name__))
+        if self.chars is not None:
+            self.chars.extend(string)
+        elif string:
+            self.tail.append(string)
+            self.size += len(string)
+        self.cache = None
+
+    def pop(self):
+        self.cache = None
+        if self.chars is not None:
+            return self.chars.pop()
+        if self.tail:
+            piece = self.tail[-1]
+            if len(piece) == 1:
+                self.tail.pop()
+            else:
+                self.tail[-1] = piece[:-1]
+            self.size -= 1
+            return piece[-1]
+        if self.end == self.head:
+            raise IndexError('pop from empty Text')
+        self.end -= 1
+        return self.string[self.end]
+
+    def put(self, index, string):
+        if self.chars is None:
+            edits = self.edits
+            if edits < 16 or not (0 <= index < len(self) and type(string) == str and len(string) == 1):
+                # same as str slicing: s[0:index] + string + s[index+1:]
+                chars = str(self)
+                self._set(chars[0:index] + string + chars[index+1:])
+                self.edits = edits + 1
+                self.cache = None
+                return
+            # the first puts after a read slice like str did, as joining the
+            # chars costs more than one slice; after 16 the join is cheaper
+            # than slicing on each put
+            self.chars = list(str(self))
+        self.cache = None
+        if 0 <= index < len(self.chars) and type(string) == str and len(string) == 1:
+            self.chars[index] = string
+        else:
+            chars = self.chars
+            self.chars = chars[0:index] + list(string) + chars[index+1:]
+
+    def poll(self):
+        if self.chars is not None or self.head == self.end:
+            # take the pushed pieces into string
+            str(self)
+        c = self.string[self.head]
+        self.head += 1
+        self.cache = None
+        return c
+
+class LoopIter:
+    # index cursor over a live sequence
+    __slots__ = ('seq', 'index')
+
+    def __init__(self, seq):
+        self.seq = seq
+        self.index = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.index >= len(self.seq):
+            raise StopIteration
+        item = self.seq[self.index]
+        self.index += 1
+        return item
+
+LIST_TYPES = (list, QueueList)
+
+class Channel:
+    # bounded queue between tasks, made by chn
+    __slots__ = ('items', 'capacity', 'receivers', 'senders')
+
+    def __init__(self, capacity):
+        self.items = collections.deque()
+        self.capacity = max(capacity, 1)
+        # tasks parked until there is an item / a free place
+        self.receivers = []
+        self.senders = []
+
+    def __repr__(self):
+        return '<chan {}/{}>'.format(len(self.items), self.capacity)
+
+class Task:
+    # green thread made by spn, runs a function on an env of its own
+    __slots__ = ('env', 'done', 'joiners')
+
+    def __init__(self, env):
+        self.env = env
+        self.done = False
+        self.joiners = []  # tasks parked in jon
+
+    @property
+    def result(self):
+        # ret of the function, kept in the base frame of the task
+        val = self.env['stack'][0].slots[0]
+        return None if val is _UNSET else val
+
+    def __repr__(self):
+        return '<task {}>'.format('done' if self.done else 'running')
+
+class Switch(Exception):
+    # raised by a command that parked the running task,
+    # the engine goes on with the env from Tasks.next()
+    pass
+
+class Tasks:
+    # Green threads of one program. Each task has its own env (pc, frames and
+    # loop states) sharing the globals of the main one. Tasks take turns
+    # cooperatively: one runs until rcv, snd, jon or slp parks it, or it ends.
+    # Parked tasks wait on the list of what they wait for, they never spin,
+    # and retry the command that parked them once woken.
+    def __init__(self, env):
+        self.main = self.current = Task(env)
+        self.ready = collections.deque()
+        self.sleeping = []  # heap of (wake time, seq, task)
+        self._seq = 0
+
+    def __getstate__(self):
+        # snapshots keep how long each task still sleeps, time.monotonic()
+        # of another process (or after a reboot) has nothing to do with ours
+        state = self.__dict__.copy()
+        now = time.monotonic()
+        state['sleeping'] = [(wake - now, seq, task) for wake, seq, task in self.sleeping]
+        return state
+
+    def __setstate__(self, state):
+        now = time.monotonic()
+        state['sleeping'] = [(now + delay, seq, task) for delay, seq, task in state['sleeping']]
+        heapq.heapify(state['sleeping'])
+        self.__dict__.update(state)
+
+    def spawn(self, env):
+        task = Task(env)
+        self.ready.append(task)
+        return task
+
+    def park(self, wait_list):
+        wait_list.append(self.current)
+        raise Switch()
+
+    def sleep(self, seconds):
+        self._seq += 1
+        heapq.heappush(self.sleeping, (time.monotonic() + seconds, self._seq, self.current))
+        raise Switch()
+
+    def wake(self, wait_list):
+        self.ready.extend(wait_list)
+        wait_list.clear()
+
+    def pause(self):
+        # the running task goes behind the ready ones
+        self.ready.append(self.current)
+
+    def finish(self):
+        self.current.done = True
+        self.wake(self.current.joiners)
+
+    def wake_time(self):
+        return self.sleeping[0][0] if self.sleeping else None
+
+    def next(self, blocking=True):
+        # env of the task to run next, None if all of them sleep and not blocking
+        while not self.ready:
+            if not self.sleeping:
+                raise RuntimeError('all tasks are blocked')
+            delay = self.sleeping[0][0] - time.monotonic()
+            if delay > 0:
+                if not blocking:
+                    return None
+                time.sleep(delay)
+            now = time.monotonic()
+            while self.sleeping and self.sleeping[0][0] <= now:
+                self.ready.append(heapq.heappop(self.sleeping)[2])
+        self.current = self.ready.popleft()
+        return self.current.env
+
 class FileLogger:
     def print(self, text, end=None):
         text += '\n' if end is None else end
         with open("log.txt", 'a') as log_file:
             log_file.write(text)
 
+    def flush(self):
+        # every print is written right away
+        pass
+
+class Profiler:
+    # execution counts and time per opcode, source line and function stack
+    def __init__(self):
+        self.ops = {}     # opcode -> [count, ns]
+        self.lines = {}   # line index -> [count, ns]
+        self.stacks = {}  # 'main;f;g' -> [count, ns]
+        self.calls = {}   # function -> number of calls
+        self._paths = ['main']
+        self._stack = None
+
+    def path(self, stack):
+        # collapsed call stack of the frames, updated as frames come and go
+        if stack is not self._stack:
+            # another task
+            self._stack = stack
+            self._paths = ['main']
+        paths = self._paths
+        while len(paths) > len(stack) + 1:
+            paths.pop()
+        while len(paths) < len(stack) + 1:
+            paths.append(paths[-1] + ';' + stack[len(paths) - 1].func)
+        return paths[-1]
+
+    def record(self, ts, pc, path, ns):
+        cmd = ts[0] if ts else '(nop)'
+        for table, key in ((self.ops, cmd), (self.lines, pc), (self.stacks, path)):
+            stat = table.get(key)
+            if stat is None:
+                table[key] = [1, ns]
+            else:
+                stat[0] += 1
+                stat[1] += ns
+        if cmd == 'cal' or cmd == 'spn':
+            func_name = ts[1][0]
+            self.calls[func_name] = self.calls.get(func_name, 0) + 1
+
+    def functions(self):
+        # function -> [instructions, self ns, total ns]
+        funcs = {}
+        for path, (count, ns) in self.stacks.items():
+            names = path.split(';')
+            for name in set(names):
+                funcs.setdefault(name, [0, 0, 0])[2] += ns
+            funcs[names[-1]][0] += count
+            funcs[names[-1]][1] += ns
+        return funcs
+
+    def report(self, src_lines=None, code_lines=None):
+        out = []
+        out.append('{:<8} {:>10} {:>12} {:>10}'.format('opcode', 'count', 'total ms', 'avg us'))
+        for cmd, (count, ns) in sorted(self.ops.items(), key=lambda i: -i[1][1]):
+            out.append('{:<8} {:>10} {:>12.3f} {:>10.3f}'.format(cmd, count, ns / 1e6, ns / count / 1e3))
+
+        out.append('')
+        out.append('{:<20} {:>8} {:>10} {:>12} {:>12}'.format('function', 'calls', 'instrs', 'self ms', 'total ms'))
+        for name, (count, self_ns, total_ns) in sorted(self.functions().items(), key=lambda i: -i[1][2]):
+            out.append('{:<20} {:>8} {:>10} {:>12.3f} {:>12.3f}'.format(
+                name, self.calls.get(name, '-'), count, self_ns / 1e6, total_ns / 1e6))
+
+        out.append('')
+        out.append('{:>6} {:>10} {:>12}  {}'.format('line', 'count', 'total ms', 'source'))
+        for pc, (count, ns) in sorted(self.lines.items(), key=lambda i: -i[1][1]):
+            # code_lines maps optimized instructions back to the source
+            ln = code_lines[pc] if code_lines else pc
+            line_src = src_lines[ln].strip() if src_lines and ln < len(src_lines) else ''
+            out.append('{:>6} {:>10} {:>12.3f}  {}'.format(ln + 1, count, ns / 1e6, line_src))
+        return '\n'.join(out) + '\n'
+
+    def collapsed(self):
+        # one 'main;f;g microseconds' line per stack, for flamegraph tools
+        return ''.join('{} {}\n'.format(path, ns // 1000) for path, (_, ns) in sorted(self.stacks.items()))
+
+    def write(self, prefix, src_lines=None, code_lines=None):
+        with open(prefix + '.prof.txt', 'w') as report_file:
+            report_file.write(self.report(src_lines, code_lines))
+        with open(prefix + '.folded', 'w') as folded_file:
+            folded_file.write(self.collapsed())
+
 class Evaluator:
-    def __init__(self, output_device=None):
+    def __init__(self, output_device=None, profiler=None):
         self.extended = {}
+        self.dispatch = self._build_dispatch()
+        self.profiler = profiler
+        if profiler is not None:
+            self.eval = self._eval_profiled
         self.display = None  # default standard out
         if output_device == 'oled':
             from oled import oled
-            self.display = oled.Display
+            self.display = oled.shared()
         elif output_device == 'file':
             self.display = FileLogger()
 
+    def snapshot(self, path, program, env, running=None, lbl=None, fun=None):
+        # write the program and its state (env of the main task and of the
+        # running one) to a file, lists and maps shared by variables stay shared
+        state = {
+            'version': VERSION,
+            'program': program,
+            'labels': lbl,
+            'funcs': fun,
+            'env': env,
+            'running': running,
+        }
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as snapshot_file:
+            _SnapshotPickler(snapshot_file, pickle.HIGHEST_PROTOCOL).dump(state)
+        os.replace(tmp_path, path)
+
+    def restore(self, path):
+        # -> ((program, labels, funcs), main env, running env) from snapshot()
+        with open(path, 'rb') as snapshot_file:
+            state = _SnapshotUnpickler(snapshot_file).load()
+        if state.get('version') != VERSION:
+            raise ValueError('snapshot of another version: {}'.format(state.get('version')))
+        return (state['program'], state['labels'], state['funcs']), state['env'], state['running']
+
     def extend(self, cmd, handler):
+        # handler(ts, env, lbl, fun, program), same as the built-in commands
+        # operands in ts are compiled, use self.expr() to get their values
         self.extended[cmd] = handler
+        self.dispatch[cmd] = handler
 
     def _assign(self, env, var, val):
-        if (var == 'ret' or var[0] == '_') and env['stack']:
-            env['stack'][-1]['env'][var] = val
+        if var[0] == LOCAL and env['stack']:
+            env['stack'][-1].slots[var[1]] = val
         else:
-            env['global'][var] = val
+            env['global'][var[-1]] = val
 
     def _get_var_val(self, env, var):
-        if (var == 'ret' or var[0] == '_') and env['stack']:
-            return env['stack'][-1]['env'][var]
-        else:
-            return env['global'].get(var)
+        if var[0] == LOCAL:
+            val = env['stack'][-1].slots[var[1]]
+            if val is not _UNSET:
+                return val
+        return env['global'].get(var[-1])
 
-    def _goto_label(self, env, lbl, name):
-        lbl_set = None
-        if env['stack']:
-            func_stack_obj = env['stack'][-1]
-            lbl_set = lbl[func_stack_obj['func']]
-        else:
-            lbl_set = lbl['global']
-        if name in lbl_set:
-            env['pc'] = lbl_set[name] - 1
-        else:
-            print('ERR invalid label in scope', env['pc']+1, name)
+    def _text(self, env, var):
+        # strings changed in place are kept as Text in the variable
+        val = self._get_var_val(env, var)
+        if type(val) == str:
+            val = Text(val)
+            self._assign(env, var, val)
+        return val
 
     def _compare(self, v1, v2):
-        if type(v1) == list and type(v2) == list:
+        if type(v1) in LIST_TYPES and type(v2) in LIST_TYPES:
             if len(v1) != len(v2):
                 return False
             for i in range(len(v1)):
@@ -157,440 +971,1582 @@ class Evaluator:
         else:
             print(str(res), end=end_char)
 
+    def flush(self):
+        # send what the display has not shown yet, before input and at exit
+        if self.display:
+            self.display.flush()
+
     def _input(self, env, var):
+        self.flush()
         text = input()
         self._assign(env, var, text)
 
-    def _goto_if_false(self, prog, env):
-        env['pc'] += 1
-        if_stack = 0
-        while env['pc'] <= len(prog):
-            cur = prog[env['pc']]
-            if cur:
-                cur = cur[0]
-                if cur in ('ife', 'ifg'):
-                    if_stack += 1
-                elif cur == 'fin':
-                    if if_stack == 0:
-                        return
-                    else:
-                        if_stack -= 1
-                elif cur == 'els':
-                    if if_stack == 0:
-                        return
-            env['pc'] += 1
+    def expr(self, env, exp):
+        kind = exp[0]
+        if kind == CONST:
+            return exp[1]
+        elif kind == GLOBAL:
+            res = env['global'].get(exp[1])
+        elif kind == LOCAL:
+            # function scoped var or arg, falls back to global
+            res = env['stack'][-1].slots[exp[1]]
+            if res is _UNSET:
+                res = env['global'].get(exp[2])
+        elif kind == NEW_LIST:
+            return []
+        else:
+            return {}
 
-    def _goto_if_end(self, prog, env):
-        if_stack = 0
-        while env['pc'] <= len(prog):
-            cur = prog[env['pc']]
-            if cur:
-                cur = cur[0]
-                if cur in ('ife', 'ifg'):
-                    if_stack += 1
-                elif cur == 'fin':
-                    if if_stack == 0:
-                        return
-                    else:
-                        if_stack -= 1
-            env['pc'] += 1
+        if type(res) == Text:
+            res = str(res)
+        if type(res) == str:
+            if len(res) > 2 and res[0] == '\'' and res[-1] == '\'':
+                res = res[1:-1]
+        elif type(res) == bool:
+            res = int(res)
+        return res
 
-    def _goto_end(self, prog, env, keyword):
-        while env['pc'] < len(prog) and (not prog[env['pc']] or prog[env['pc']][0] != keyword):
-            env['pc'] += 1
+    def _ref(self, env, exp):
+        # expr for a value that gets stored (let, psh, put, args, ret, snd):
+        # a queue may be aliased from now on, see QueueList
+        res = self.expr(env, exp)
+        if type(res) == QueueList:
+            res.shared = True
+        return res
 
-    def _back_to_loop_head(self, prog, env):
-        for_stack = 0
-        env['pc'] -= 1
-        while env['pc'] > 0:
-            cur = prog[env['pc']]
-            if cur:
-                cur = cur[0]
-                if cur == 'for':
-                    if for_stack == 0:
-                        env['pc'] -= 1
-                        return
-                    for_stack -= 1
-                elif cur == 'nxt':
-                    for_stack += 1
-            env['pc'] -= 1
 
-    def _goto_loop_end(self, prog, env):
-        env['pc'] += 1
-        for_stack = 0
-        while env['pc'] < len(prog):
-            cur = prog[env['pc']]
-            if cur:
-                cur = cur[0]
-                if cur == 'for':
-                    for_stack += 1
-                elif cur == 'nxt':
-                    if for_stack == 0:
-                        return
-                    for_stack -= 1
-            env['pc'] += 1
+    def _build_dispatch(self):
+        return {
+            'let': self._op_let,
+            'prt': self._op_prt,
+            'inp': self._op_inp,
+            'prs': self._op_prs,
 
-    def expr(self, env, exp):
-        res = None
-        if exp[0] == '$':
-            var_name = exp[1:]
-            if var_name == 'nil':
-                res = None
-            else:
-                # env val
-                val = None
-                func_stack_obj = env['stack'][-1] if env['stack'] else None
-                if func_stack_obj and var_name in func_stack_obj['env']:
-                    # function scoped var
-                    if self._is_numeric(var_name):
-                        # function arg
-                        val = func_stack_obj['env'][var_name]
-                    else:
-                        val = func_stack_obj['env'][var_name]
-                else:
-                    # global var
-                    val = env['global'].get(var_name)
-                
-                if val is None:
-                    res = None
-                elif type(val) == str and len(val) > 2 and val[0] == '\'' and val[-1] == '\'':
-                    res = val[1:-1]
-                else:
-                    res = val
-        elif exp == '[]':
-            res = []
-        elif exp == '{}':
-            res = {}
-        elif exp[0] == '\'' and exp[-1] == '\'':
-            res = exp[1:-1]
-        elif self._is_numeric(exp):
-            res = int(exp)
-        else:
-            res = exp
+            # === JUMP ===
+            'jmp': self._op_jmp,
+            'jeq': self._op_jeq,
+            'jne': self._op_jne,
+            'jlt': self._op_jlt,
+            'jgt': self._op_jgt,
+            'ife': self._op_ife,
+            'ifg': self._op_ifg,
+            'els': self._op_els,
+            'fin': self._op_fin,
 
-        if type(res) == bool:
-            res = int(res)
-        return res
+            # === ARITHMATIC ===
+            'add': self._op_add,
+            'sub': self._op_sub,
+            'mul': self._op_mul,
+            'mod': self._op_mod,
+            'div': self._op_div,
+
+            # === DATA TYPE ===
+            'int': self._op_int,
+            'str': self._op_str,
+            'typ': self._op_typ,
 
+            # === LIST ===
+            'psh': self._op_psh,
+            'pop': self._op_pop,
+            'pol': self._op_pol,
+            'len': self._op_len,
 
+            # === MAP ===
+            'put': self._op_put,
+            'get': self._op_get,
+            'key': self._op_key,
+            'del': self._op_del,
+
+            # === MISC ===
+            'rnd': self._op_rnd,
+            'tim': self._op_tim,
+            'slp': self._op_slp,
+            'snp': self._op_snp,
+
+            # === FUNC ===
+            'def': self._op_def,
+            'ret': self._op_ret,
+            'end': self._op_end,
+            'cal': self._op_cal,
+
+            # === FOR LOOP ===
+            'for': self._op_for,
+            'nxt': self._op_nxt,
+
+            # === TASKS ===
+            'spn': self._op_spn,
+            'jon': self._op_jon,
+            'chn': self._op_chn,
+            'snd': self._op_snd,
+            'rcv': self._op_rcv,
+
+            # === SUPERINSTRUCTIONS ===
+            'let/k': self._op_let_k,
+            'jeq/k': self._op_jeq_k,
+            'jne/k': self._op_jne_k,
+            'jlt/k': self._op_jlt_k,
+            'jgt/k': self._op_jgt_k,
+            'ife/k': self._op_ife_k,
+            'ifg/k': self._op_ifg_k,
+            'add/jmp': self._op_add_jmp,
+        }
 
     def eval(self, ts, env, lbl, fun, program):
         self.env = env
-        if len(ts) == 0:
-            return
-        if ts[0][0] == '#':
-            return
-        cmd = ts[0]
-        if cmd == 'let':
-            var = ts[1]
-            val = self.expr(env, ts[2])
-            self._assign(env, var, val)
-        elif cmd == 'prt':
-            self._print(env, ts)
-        elif cmd == 'inp':
-            self._input(env, ts[1])
-        elif cmd == 'prs':
-            data = self.expr(env, ts[2])
-            self._assign(env, ts[1], json.loads(data))
-
-
-        # === JUMP ===
-        elif cmd == 'jmp':
-            self._goto_label(env, lbl, ts[1])
-        elif cmd == 'jeq':
-            if self._compare(self.expr(env, ts[1]), self.expr(env, ts[2])):
-                self._goto_label(env, lbl, ts[3])
-        elif cmd == 'jne':
-            if not self._compare(self.expr(env, ts[1]), self.expr(env, ts[2])):
-                self._goto_label(env, lbl, ts[3])
-        elif cmd == 'jlt':
-            if self.expr(env, ts[1]) < self.expr(env, ts[2]):
-                self._goto_label(env, lbl, ts[3])
-        elif cmd == 'jgt':
-            if int(self.expr(env, ts[1])) > int(self.expr(env, ts[2])):
-                self._goto_label(env, lbl, ts[3])
-        elif cmd == 'ife':
-            if not self._compare(self.expr(env, ts[1]), self.expr(env, ts[2])):
-                self._goto_if_false(program, env)
-        elif cmd == 'ifg':
-            if self.expr(env, ts[1]) <= self.expr(env, ts[2]):
-                self._goto_if_false(program, env)
-        elif cmd == 'els':
-            self._goto_if_end(program, env)
-        elif cmd == 'fin':
+        if not ts:
             return
+        # labels and unknown commands are not in the table
+        handler = self.dispatch.get(ts[0])
+        if handler is not None:
+            handler(ts, env, lbl, fun, program)
 
+    def _eval_profiled(self, ts, env, lbl, fun, program):
+        pc = env['pc']
+        path = self.profiler.path(env['stack'])
+        start = time.perf_counter_ns()
+        Evaluator.eval(self, ts, env, lbl, fun, program)
+        self.profiler.record(ts, pc, path, time.perf_counter_ns() - start)
 
-        # === ARITHMATIC ===
-        elif cmd == 'add':
-            var = ts[1]
-            v1 = self.expr(env, ts[2])
-            v2 = self.expr(env, ts[3])
-            if v1 is None and self._is_numeric(v2):
-                self._assign(env, var, chr(v2))
-            else:
-                if type(v1) == str or type(v2) == str:
-                    v1, v2 = str(v1), str(v2)
-                self._assign(env, var, v1 + v2)
-        elif cmd == 'sub':
-            var = ts[1]
-            v1 = self.expr(env, ts[2])
-            v2 = self.expr(env, ts[3])
-            if type(v1) == str and v2 is None:
-                self._assign(env, var, ord(v1))
-            else:
-                self._assign(env, var, v1 - v2)
-        elif cmd == 'mul':
-            var = ts[1]
-            v1 = self.expr(env, ts[2])
-            v2 = self.expr(env, ts[3])
-            if type(v1) == str and type(v2) == int and v2 > 0:
-                # same behavior as Python
-                self._assign(env, var, v1 * v2)
-            else:
-                self._assign(env, var, int(v1) * int(v2))
-        elif cmd == 'mod':
-            var = ts[1]
-            v1 = self.expr(env, ts[2])
-            v2 = self.expr(env, ts[3])
-            self._assign(env, var, v1 % v2)
-        elif cmd == 'div':
-            var = ts[1]
-            v1 = self.expr(env, ts[2])
-            v2 = self.expr(env, ts[3])
-            self._assign(env, var, v1 // v2)
-
-        # === DATA TYPE ===
-        elif cmd == 'int':
-            param = self.expr(env, ts[2])
-            res = None
-            if self._is_numeric(param):
-                res = int(param)
-            self._assign(env, ts[1], res)
-        elif cmd == 'str':
-            val = self.expr(env, ts[2])
-            self._assign(env, ts[1], str(val))
-        elif cmd == 'typ':
-            val = self.expr(env, ts[2])
-            t = 'err'
-            if type(val) == int:
-                t = 'int'
-            elif type(val) == str:
-                t = 'str'
-            elif type(val) == list:
-                t = 'list'
-            elif type(val) == dict:
-                t = 'map'
-            elif val is None:
-                t = 'nil'
-            self._assign(env, ts[1], t)
-            #print(type(val))
-
-
-        # === LIST ===
-        elif cmd == 'psh':
-            list_var = ts[1][1:] # remove $
-            list_val = self._get_var_val(env, list_var)
+    def _op_let(self, ts, env, lbl, fun, program):
+        var = ts[1]
+        val = self._ref(env, ts[2])
+        self._assign(env, var, val)
+
+    def _op_prt(self, ts, env, lbl, fun, program):
+        self._print(env, ts)
+
+    def _op_inp(self, ts, env, lbl, fun, program):
+        self._input(env, ts[1])
+
+    def _op_prs(self, ts, env, lbl, fun, program):
+        data = self.expr(env, ts[2])
+        self._assign(env, ts[1], json.loads(data))
+
+
+    # === JUMP ===
+    def _op_jmp(self, ts, env, lbl, fun, program):
+        env['pc'] = ts[1]
+
+    def _op_jeq(self, ts, env, lbl, fun, program):
+        if self._compare(self.expr(env, ts[1]), self.expr(env, ts[2])):
+            env['pc'] = ts[3]
+
+    def _op_jne(self, ts, env, lbl, fun, program):
+        if not self._compare(self.expr(env, ts[1]), self.expr(env, ts[2])):
+            env['pc'] = ts[3]
+
+    def _op_jlt(self, ts, env, lbl, fun, program):
+        if self.expr(env, ts[1]) < self.expr(env, ts[2]):
+            env['pc'] = ts[3]
+
+    def _op_jgt(self, ts, env, lbl, fun, program):
+        if int(self.expr(env, ts[1])) > int(self.expr(env, ts[2])):
+            env['pc'] = ts[3]
+
+    def _op_ife(self, ts, env, lbl, fun, program):
+        if not self._compare(self.expr(env, ts[1]), self.expr(env, ts[2])):
+            # jump to the matching els or fin
+            env['pc'] = ts[-1]
+
+    def _op_ifg(self, ts, env, lbl, fun, program):
+        if self.expr(env, ts[1]) <= self.expr(env, ts[2]):
+            env['pc'] = ts[-1]
+
+    def _op_els(self, ts, env, lbl, fun, program):
+        # jump to the matching fin
+        env['pc'] = ts[-1]
+
+    def _op_fin(self, ts, env, lbl, fun, program):
+        return
+
+
+    # === ARITHMATIC ===
+    def _op_add(self, ts, env, lbl, fun, program):
+        var = ts[1]
+        v1 = self.expr(env, ts[2])
+        v2 = self.expr(env, ts[3])
+        if v1 is None and self._is_numeric(v2):
+            self._assign(env, var, chr(v2))
+        else:
+            if type(v1) == str or type(v2) == str:
+                v1, v2 = str(v1), str(v2)
+            self._assign(env, var, v1 + v2)
+
+    def _op_sub(self, ts, env, lbl, fun, program):
+        var = ts[1]
+        v1 = self.expr(env, ts[2])
+        v2 = self.expr(env, ts[3])
+        if type(v1) == str and v2 is None:
+            self._assign(env, var, ord(v1))
+        else:
+            self._assign(env, var, v1 - v2)
+
+    def _op_mul(self, ts, env, lbl, fun, program):
+        var = ts[1]
+        v1 = self.expr(env, ts[2])
+        v2 = self.expr(env, ts[3])
+        if type(v1) == str and type(v2) == int and v2 > 0:
+            # same behavior as Python
+            self._assign(env, var, v1 * v2)
+        else:
+            self._assign(env, var, int(v1) * int(v2))
+
+    def _op_mod(self, ts, env, lbl, fun, program):
+        var = ts[1]
+        v1 = self.expr(env, ts[2])
+        v2 = self.expr(env, ts[3])
+        self._assign(env, var, v1 % v2)
+
+    def _op_div(self, ts, env, lbl, fun, program):
+        var = ts[1]
+        v1 = self.expr(env, ts[2])
+        v2 = self.expr(env, ts[3])
+        self._assign(env, var, v1 // v2)
+
+
+    # === DATA TYPE ===
+    def _op_int(self, ts, env, lbl, fun, program):
+        param = self.expr(env, ts[2])
+        res = None
+        if self._is_numeric(param):
+            res = int(param)
+        self._assign(env, ts[1], res)
+
+    def _op_str(self, ts, env, lbl, fun, program):
+        val = self.expr(env, ts[2])
+        self._assign(env, ts[1], str(val))
+
+    def _op_typ(self, ts, env, lbl, fun, program):
+        val = self.expr(env, ts[2])
+        t = 'err'
+        if type(val) == int:
+            t = 'int'
+        elif type(val) == str:
+            t = 'str'
+        elif type(val) in LIST_TYPES:
+            t = 'list'
+        elif type(val) == dict:
+            t = 'map'
+        elif val is None:
+            t = 'nil'
+        elif type(val) == Channel:
+            t = 'chan'
+        elif type(val) == Task:
+            t = 'task'
+        self._assign(env, ts[1], t)
+
+
+    # === LIST ===
+    def _op_psh(self, ts, env, lbl, fun, program):
+        list_var = ts[1]
+        list_val = self._text(env, list_var)
+        if type(list_val) == Text:
+            # string
             for val in ts[2:]:
-                if type(list_val) == str:
-                    # string
-                    v = self.expr(env, val)
-                    self._assign(env, list_var, list_val + v)
-                    list_val = self._get_var_val(env, list_var)
-                else:
-                    # list
-                    list_val.append(self.expr(env, val))
-        elif cmd == 'pop':
-            list_var = ts[1][1:] # remove $
-            list_val = self._get_var_val(env, list_var)
-            var_name = ts[2]
-            if type(list_val) == str:
-                # string
-                if len(list_val) == 0:
-                    self._assign(env, var_name, '')
-                else:
-                    self._assign(env, var_name, list_val[-1])
-                    self._assign(env, list_var, list_val[:-1])
-            else:
-                # list
-                val = list_val.pop() if list_val else None
-                self._assign(env, var_name, val)
-        elif cmd == 'pol':
-            list_var = ts[1][1:] # remove $
-            list_val = self._get_var_val(env, list_var)
-            var_name = ts[2]
-            if type(list_val) == str:
-                # string
-                if len(list_val) == 0:
-                    self._assign(env, var_name, '')
-                else:
-                    self._assign(env, var_name, list_val[0])
-                    self._assign(env, list_var, list_val[1:])
-            elif type(list_val) == list:
-                # list
-                if len(list_val) == 0:
-                    self._assign(env, var_name, None)
-                else:
-                    self._assign(env, var_name, list_val[0])
-                    self._assign(env, list_var, list_val[1:])
+                list_val.push(self.expr(env, val))
+        else:
+            # list
+            for val in ts[2:]:
+                list_val.append(self._ref(env, val))
+
+    def _op_pop(self, ts, env, lbl, fun, program):
+        list_var = ts[1]
+        list_val = self._text(env, list_var)
+        var_name = ts[2]
+        if type(list_val) == Text:
+            # string
+            if len(list_val) == 0:
+                self._assign(env, var_name, '')
             else:
-                print('ERR cannot pol data type: ', type(list_val), ' line:', env['pc']+1)
-        elif cmd == 'len':
-            list_var = ts[1][1:] # remove $
-            list_val = self._get_var_val(env, list_var)
-            var_name = ts[2]
-            # list, dict, str
-            self._assign(env, var_name, len(list_val))
-
-
-        # === MAP ===
-        elif cmd == 'put':
-            map_var_name = ts[1][1:]
-            map_var_val = self._get_var_val(env, map_var_name)
-            map_key = self.expr(env, ts[2])
-            map_val = self.expr(env, ts[3])
-            if type(map_var_val) == str:
-                map_var_val = map_var_val[0:map_key] + map_val + map_var_val[map_key+1:]
-                self._assign(env, map_var_name, map_var_val)
+                self._assign(env, var_name, list_val.pop())
+        else:
+            # list
+            val = list_val.pop() if list_val else None
+            self._assign(env, var_name, val)
+
+    def _op_pol(self, ts, env, lbl, fun, program):
+        # the first pol turns a list into a queue, later ones are O(1)
+        # while the queue is not shared; like the list[1:] pol always was,
+        # it never changes other variables holding the list
+        list_var = ts[1]
+        list_val = self._text(env, list_var)
+        var_name = ts[2]
+        if type(list_val) == list or (type(list_val) == QueueList and list_val.shared):
+            list_val = QueueList(list_val)
+
+        if type(list_val) == Text:
+            # string
+            if len(list_val) == 0:
+                self._assign(env, var_name, '')
             else:
-                map_var_val[map_key] = map_val
-        elif cmd == 'get':
-            map_var_name = ts[1][1:]
-            map_var_val = self._get_var_val(env, map_var_name)
-            map_key = self.expr(env, ts[2])
-            if type(map_var_val) == dict:
-                # map
-                map_val_by_key = map_var_val.get(map_key)
+                self._assign(env, var_name, list_val.poll())
+        elif type(list_val) == QueueList:
+            # list
+            if len(list_val) == 0:
+                self._assign(env, var_name, None)
             else:
-                # str and list
-                if map_key < len(map_var_val):
-                    map_val_by_key = map_var_val[map_key]
-                else:
-                    map_val_by_key = None
-                if type(map_var_val) == str and map_val_by_key is None:
-                    map_val_by_key = ''
-            self._assign(env, ts[3], map_val_by_key)
-        elif cmd == 'key':
-            map_var_name = ts[1][1:]
-            map_var_val = self._get_var_val(env, map_var_name)
-            self._assign(env, ts[2], list(map_var_val.keys()))
-        elif cmd == 'del':
-            map_var_name = ts[1][1:]
-            map_key = self.expr(env, ts[2])
-            map_var_val = self._get_var_val(env, map_var_name)
-            del map_var_val[map_key]
-
-
-        # === MISC ===
-        elif cmd == 'rnd':
-            a, b = self.expr(env, ts[2]), self.expr(env, ts[3])
-            val = random.randint(a, b)
-            self._assign(env, ts[1], val)
-        elif cmd == 'tim':
-            time_type = self.expr(env, ts[2])
-            today = datetime.date.today()
-            now = datetime.datetime.now()
-            val = -1
-            if time_type == 'year':
-                val = today.year
-            elif time_type == 'month':
-                val = today.month
-            elif time_type == 'date':
-                val = today.day
-            elif time_type == 'day':
-                val = today.isoweekday()
-            elif time_type == 'hour':
-                val = now.hour
-            elif time_type == 'minute':
-                val = now.minute
-            elif time_type == 'second':
-                val = now.second
-            elif time_type == 'milli':
-                val = time.time_ns() % 10**9 // 10**6
-            elif time_type == 'now':
-                val = time.time_ns() // 10**6
-            self._assign(env, ts[1], val)
-        elif cmd == 'slp':
-            time.sleep(self.expr(env, ts[1]) / 1000)
-
-        # === FUNC ===
-        elif cmd == 'def':
-            self._goto_end(program, env, 'end')
-        elif cmd in ('ret', 'end'):
-            val = None  # return None by default
-            if len(ts) > 1:
-                val = self.expr(env, ts[1])
-            stack_obj = env['stack'].pop()
-            if cmd == 'ret':
-                self._assign(env, 'ret', val)
-            env['pc'] = stack_obj['pc']
-        elif cmd == 'cal':
-            func_name = ts[1]
-            args = ts[2:]
-            func_env = {}
-            for i, v in enumerate(args):
-                func_env[str(i)] = self.expr(env, v)
-            env['stack'].append({
-                'func': func_name,
-                'pc': env['pc'],
-                'env': func_env
-                })
-            env['pc'] = fun[func_name]
-
-
-        # === FOR LOOP ===
-        elif cmd == 'for':
-            var = ts[1]
-            rg = self.expr(env, ts[2])
-            if var not in env['loops']:
-                # init a new loop state
-                rg_list = []
-                if type(rg) == int:
-                    rg_list = list(range(rg))
-                elif type(rg) == list:
-                    rg_list = rg
-                elif type(rg) == str:
-                    rg_list = list(rg)
-                elif type(rg) == dict:
-                    rg_list = list(rg.keys())
-                env['loops'][var] = {
-                    'items': rg_list,
-                    'pc': env['pc'],
-                    'index': 0,
-                }
-
-            loop_state = env['loops'][var]
-            items = loop_state['items']
-            index = loop_state['index']
-            if index >= len(items):
-                del env['loops'][var]
-                self._goto_loop_end(program, env)
+                self._assign(env, var_name, list_val.popleft())
+                self._assign(env, list_var, list_val)
+        else:
+            print('ERR cannot pol data type: ', type(list_val), ' line:', program.lines[env['pc']]+1)
+
+    def _op_len(self, ts, env, lbl, fun, program):
+        list_var = ts[1]
+        list_val = self._get_var_val(env, list_var)
+        var_name = ts[2]
+        # list, dict, str
+        self._assign(env, var_name, len(list_val))
+
+
+    # === MAP ===
+    def _op_put(self, ts, env, lbl, fun, program):
+        map_var_name = ts[1]
+        map_var_val = self._text(env, map_var_name)
+        map_key = self.expr(env, ts[2])
+        map_val = self._ref(env, ts[3])
+        if type(map_var_val) == Text:
+            map_var_val.put(map_key, map_val)
+        else:
+            map_var_val[map_key] = map_val
+
+    def _op_get(self, ts, env, lbl, fun, program):
+        map_var_name = ts[1]
+        map_var_val = self._get_var_val(env, map_var_name)
+        map_key = self.expr(env, ts[2])
+        if type(map_var_val) == dict:
+            # map
+            map_val_by_key = map_var_val.get(map_key)
+        else:
+            # str and list
+            if map_key < len(map_var_val):
+                map_val_by_key = map_var_val[map_key]
             else:
-                self._assign(env, var, items[index])
-                loop_state['index'] += 1
-        elif cmd == 'nxt':
-            self._back_to_loop_head(program, env)
+                map_val_by_key = None
+            if type(map_var_val) in (str, Text) and map_val_by_key is None:
+                map_val_by_key = ''
+        self._assign(env, ts[3], map_val_by_key)
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print('Usage: python3 runtime.py <input_file> [<output-device>]')
-        sys.exit(1)
-    
-    output_device = None
-    if len(sys.argv) >= 3:
-        output_device = sys.argv[2]
+    def _op_key(self, ts, env, lbl, fun, program):
+        map_var_name = ts[1]
+        map_var_val = self._get_var_val(env, map_var_name)
+        self._assign(env, ts[2], list(map_var_val.keys()))
 
-    parser = Parser()
-    evaluator = Evaluator(output_device=output_device)
-    env = {
+    def _op_del(self, ts, env, lbl, fun, program):
+        map_var_name = ts[1]
+        map_key = self.expr(env, ts[2])
+        map_var_val = self._get_var_val(env, map_var_name)
+        del map_var_val[map_key]
+
+
+    # === MISC ===
+    def _op_rnd(self, ts, env, lbl, fun, program):
+        a, b = self.expr(env, ts[2]), self.expr(env, ts[3])
+        val = random.randint(a, b)
+        self._assign(env, ts[1], val)
+
+    def _op_tim(self, ts, env, lbl, fun, program):
+        time_type = self.expr(env, ts[2])
+        today = datetime.date.today()
+        now = datetime.datetime.now()
+        val = -1
+        if time_type == 'year':
+            val = today.year
+        elif time_type == 'month':
+            val = today.month
+        elif time_type == 'date':
+            val = today.day
+        elif time_type == 'day':
+            val = today.isoweekday()
+        elif time_type == 'hour':
+            val = now.hour
+        elif time_type == 'minute':
+            val = now.minute
+        elif time_type == 'second':
+            val = now.second
+        elif time_type == 'milli':
+            val = time.time_ns() % 10**9 // 10**6
+        elif time_type == 'now':
+            val = time.time_ns() // 10**6
+        self._assign(env, ts[1], val)
+
+    def _op_slp(self, ts, env, lbl, fun, program):
+        seconds = self.expr(env, ts[1]) / 1000
+        tasks = env.get('tasks')
+        if tasks is None:
+            time.sleep(seconds)
+        else:
+            # let the other tasks run, this one goes on after slp
+            env['pc'] += 1
+            tasks.sleep(seconds)
+
+    def _op_snp(self, ts, env, lbl, fun, program):
+        # snapshot to the given file, a resumed program goes on after snp
+        tasks = env.get('tasks')
+        main = tasks.main.env if tasks else env
+        env['pc'] += 1
+        try:
+            self.snapshot(self.expr(env, ts[1]), program, main, env, lbl, fun)
+        finally:
+            env['pc'] -= 1
+
+
+    # === FUNC ===
+    def _op_def(self, ts, env, lbl, fun, program):
+        # skip the function body
+        env['pc'] = ts[-1]
+
+    def _op_ret(self, ts, env, lbl, fun, program):
+        val = None  # return None by default
+        if len(ts) > 1:
+            val = self._ref(env, ts[1])
+        frame = env['stack'].pop()
+        self._assign(env, RET, val)
+        env['pc'] = frame.pc
+
+    def _op_end(self, ts, env, lbl, fun, program):
+        frame = env['stack'].pop()
+        env['pc'] = frame.pc
+
+    def _op_cal(self, ts, env, lbl, fun, program):
+        func_name, func_pc, slot_count, arg_slots = ts[1]
+        if slot_count is None:
+            func_name, func_pc, slot_count, arg_slots = program.link(env['pc'])[1]
+        slots = [_UNSET] * slot_count
+        for slot, v in zip(arg_slots, ts[2:]):
+            slots[slot] = self._ref(env, v)
+        env['stack'].append(Frame(func_name, env['pc'], slots))
+        env['pc'] = func_pc
+
+
+    # === FOR LOOP ===
+    def _loop_iter(self, rg):
+        # lists are walked by index, so items pushed during the loop are visited;
+        # map keys are taken when the loop starts
+        if type(rg) == int:
+            return iter(range(rg))
+        elif type(rg) in (list, str):
+            return iter(rg)
+        elif type(rg) == QueueList:
+            return LoopIter(rg)
+        elif type(rg) == dict:
+            return iter(list(rg))
+        return iter(())
+
+    def _op_for(self, ts, env, lbl, fun, program):
+        # loop state lives in the current frame, keyed by the loop head
+        if env['stack']:
+            frame = env['stack'][-1]
+            if frame.loops is None:
+                frame.loops = {}
+            loops = frame.loops
+        else:
+            loops = env['loops']
+        pc = env['pc']
+        loop_iter = loops.get(pc)
+        if loop_iter is None:
+            loop_iter = loops[pc] = self._loop_iter(self.expr(env, ts[2]))
+
+        item = next(loop_iter, _LOOP_END)
+        if item is _LOOP_END:
+            del loops[pc]
+            # jump to the matching nxt
+            env['pc'] = ts[-1]
+        else:
+            self._assign(env, ts[1], item)
+
+    def _op_nxt(self, ts, env, lbl, fun, program):
+        # back to the line before the loop head
+        env['pc'] = ts[-1]
+
+
+    # === TASKS ===
+    def _tasks(self, env):
+        tasks = env.get('tasks')
+        if tasks is None:
+            tasks = env['tasks'] = Tasks(env)
+        return tasks
+
+    def _op_spn(self, ts, env, lbl, fun, program):
+        # start the function as a task, ret gets the task
+        func_name, func_pc, slot_count, arg_slots = ts[1]
+        if slot_count is None:
+            func_name, func_pc, slot_count, arg_slots = program.link(env['pc'])[1]
+        slots = [_UNSET] * slot_count
+        for slot, v in zip(arg_slots, ts[2:]):
+            slots[slot] = self._ref(env, v)
+        tasks = self._tasks(env)
+        # returning from the function ends the task, its base frame takes ret
+        last = len(program) - 1
+        task = tasks.spawn({
+            'pc': func_pc + 1,
+            'stack': [Frame('task', last, [_UNSET]), Frame(func_name, last, slots)],
+            'global': env['global'],
+            'loops': {},
+            'tasks': tasks,
+        })
+        self._assign(env, RET, task)
+
+    def _op_jon(self, ts, env, lbl, fun, program):
+        # wait for a task to end, ret gets its result
+        task = self.expr(env, ts[1])
+        if not task.done:
+            self._tasks(env).park(task.joiners)
+        self._assign(env, RET, task.result)
+
+    def _op_chn(self, ts, env, lbl, fun, program):
+        capacity = self.expr(env, ts[2]) if len(ts) > 2 else 1
+        self._assign(env, ts[1], Channel(capacity))
+
+    def _op_snd(self, ts, env, lbl, fun, program):
+        chan = self.expr(env, ts[1])
+        if len(chan.items) >= chan.capacity:
+            self._tasks(env).park(chan.senders)
+        chan.items.append(self._ref(env, ts[2]))
+        if chan.receivers:
+            env['tasks'].wake(chan.receivers)
+
+    def _op_rcv(self, ts, env, lbl, fun, program):
+        chan = self.expr(env, ts[1])
+        if not chan.items:
+            self._tasks(env).park(chan.receivers)
+        self._assign(env, ts[2], chan.items.popleft())
+        if chan.senders:
+            env['tasks'].wake(chan.senders)
+
+
+    # === SUPERINSTRUCTIONS ===
+    # made by the Optimizer, the second operand of /k is a constant
+    def _op_let_k(self, ts, env, lbl, fun, program):
+        self._assign(env, ts[1], ts[2][1])
+
+    def _op_jeq_k(self, ts, env, lbl, fun, program):
+        if self.expr(env, ts[1]) == ts[2][1]:
+            env['pc'] = ts[3]
+
+    def _op_jne_k(self, ts, env, lbl, fun, program):
+        if not self.expr(env, ts[1]) == ts[2][1]:
+            env['pc'] = ts[3]
+
+    def _op_jlt_k(self, ts, env, lbl, fun, program):
+        if self.expr(env, ts[1]) < ts[2][1]:
+            env['pc'] = ts[3]
+
+    def _op_jgt_k(self, ts, env, lbl, fun, program):
+        # the constant is already an int
+        if int(self.expr(env, ts[1])) > ts[2][1]:
+            env['pc'] = ts[3]
+
+    def _op_ife_k(self, ts, env, lbl, fun, program):
+        if not self.expr(env, ts[1]) == ts[2][1]:
+            env['pc'] = ts[-1]
+
+    def _op_ifg_k(self, ts, env, lbl, fun, program):
+        if self.expr(env, ts[1]) <= ts[2][1]:
+            env['pc'] = ts[-1]
+
+    def _op_add_jmp(self, ts, env, lbl, fun, program):
+        # add x $x 1 followed by jmp
+        self._op_add(ts, env, lbl, fun, program)
+        env['pc'] = ts[4]
+
+def _read_value(res):
+    # same conversions as the tail of Evaluator.expr
+    if type(res) == Text:
+        res = str(res)
+    if type(res) == str:
+        if len(res) > 2 and res[0] == '\'' and res[-1] == '\'':
+            res = res[1:-1]
+    elif type(res) == bool:
+        res = int(res)
+    return res
+
+def _read_ref(res):
+    # _read_value of a value that gets stored, like Evaluator._ref
+    if type(res) == QueueList:
+        res.shared = True
+        return res
+    return _read_value(res)
+
+class FastEvaluator:
+    # Alternate engine: every basic block of a compiled program is turned into
+    # a generated Python function with its operands inlined. Branches inside a
+    # block are plain Python ifs and each block returns the pc of the next one.
+    # Blocks are generated the first time they run. Commands without a
+    # generator go through the evaluator's dispatch table.
+
+    UNCONDITIONAL = ('jmp', 'els', 'nxt', 'def', 'ret', 'end', 'cal', 'add/jmp')
+
+    def __init__(self, evaluator, program):
+        self.evaluator = evaluator
+        self.program = program
+        self.blocks = [None] * len(program)
+        self.sources = {}  # generated code by block start, for debugging
+        self.leaders = {0}
+        self.in_func = [False] * len(program)
+        self._scan(0, len(program))
+        self.namespace = {
+            'Frame': Frame,
+            'UNSET': _UNSET,
+            'LOOP_END': _LOOP_END,
+            'LIST_TYPES': LIST_TYPES,
+            'FIX': (str, bool, Text),
+            'REF': (str, bool, Text, QueueList),
+            'Text': Text,
+            'fix': _read_value,
+            'ref': _read_ref,
+            'cmp': evaluator._compare,
+            'isnum': evaluator._is_numeric,
+            'loop_iter': evaluator._loop_iter,
+            'P': program,
+        }
+
+    def _scan(self, start, stop):
+        # block leaders of the instructions from start to stop
+        for pc in range(start, stop):
+            ins = self.program[pc]
+            cmd = ins[0] if ins else None
+            if cmd in JUMP_TARGET:
+                self.leaders.add(ins[JUMP_TARGET[cmd]] + 1)
+            elif cmd in ('cal', 'spn'):
+                self.leaders.add(ins[1][1] + 1)
+            if cmd in self.UNCONDITIONAL:
+                self.leaders.add(pc + 1)
+            if cmd == 'def':
+                for i in range(pc + 1, ins[-1] + 1):
+                    self.in_func[i] = True
+
+    def run(self, env, running=None):
+        # env of the main task, running: env of another task to go on with
+        main = env
+        env = running or env
+        blocks = self.blocks
+        pc = env['pc']
+        end = len(blocks)
+        while True:
+            try:
+                while pc < end:
+                    block = blocks[pc]
+                    if block is None:
+                        block = self._compile_block(pc)
+                    pc = block(env)
+            except Switch:
+                # a task was parked, its pc is on the command that parked it
+                env = env['tasks'].next()
+                pc = env['pc']
+                continue
+            env['pc'] = pc
+            if env is main:
+                break
+            env['tasks'].finish()
+            env = env['tasks'].next()
+            pc = env['pc']
+
+    def _compile_block(self, start):
+        body = ['G = env[\'global\']']
+        if self.in_func[start]:
+            body.append('S = env[\'stack\'][-1].slots')
+        pc = start
+        while True:
+            ins = self.program[pc]
+            body += self._gen(pc, ins)
+            pc += 1
+            if ins and ins[0] in self.UNCONDITIONAL:
+                break
+            if pc >= len(self.program) or pc in self.leaders:
+                body.append('return {}'.format(pc))
+                break
+        name = '_block_{}'.format(start)
+        src = 'def {}(env):\n'.format(name) + ''.join('    ' + line + '\n' for line in body)
+        self.sources[start] = src
+        exec(compile(src, '<block {}>'.format(self.program.lines[start] + 1), 'exec'), self.namespace)
+        self.blocks[start] = self.namespace[name]
+        return self.blocks[start]
+
+    def _load(self, exp, name, ref=False):
+        # -> (lines, python expression) for an operand, ref: the value gets
+        # stored, like Evaluator._ref
+        kind = exp[0]
+        if kind == CONST:
+            return [], '({!r})'.format(exp[1])
+        elif kind == NEW_LIST:
+            return [], '[]'
+        elif kind == NEW_MAP:
+            return [], '{}'
+        elif kind == GLOBAL:
+            lines = ['{} = G.get({!r})'.format(name, exp[1])]
+        else:
+            lines = [
+                '{} = S[{}]'.format(name, exp[1]),
+                'if {0} is UNSET: {0} = G.get({1!r})'.format(name, exp[2]),
+            ]
+        if ref:
+            lines.append('if {0}.__class__ in REF: {0} = ref({0})'.format(name))
+        else:
+            lines.append('if {0}.__class__ in FIX: {0} = fix({0})'.format(name))
+        return lines, name
+
+    def _load_var(self, var, name):
+        # value of a $list/$map operand as is, like Evaluator._get_var_val
+        if var[0] == GLOBAL:
+            return ['{} = G.get({!r})'.format(name, var[1])]
+        return [
+            '{} = S[{}]'.format(name, var[1]),
+            'if {0} is UNSET: {0} = G.get({1!r})'.format(name, var[2]),
+        ]
+
+    def _store(self, var, value):
+        if var[0] == LOCAL:
+            return 'S[{}] = {}'.format(var[1], value)
+        return 'G[{!r}] = {}'.format(var[1], value)
+
+    def _type_test(self, exp, value, typ):
+        # python test for the type of an operand, folded for constants
+        if exp[0] == CONST:
+            return str(exp[1] is None if typ is None else type(exp[1]) == typ)
+        elif exp[0] in (NEW_LIST, NEW_MAP):
+            return str(typ == (list if exp[0] == NEW_LIST else dict))
+        elif typ is None:
+            return '{} is None'.format(value)
+        return '{}.__class__ is {}'.format(value, typ.__name__)
+
+    def _branches(self, cases):
+        # if/elif/else from (test, statement) pairs, dropping tests known to be False
+        lines = []
+        for test, stmt in cases:
+            parts = [t for t in test.split(' and ') if t != 'True']
+            if 'False' in parts:
+                continue
+            if not parts:
+                lines.append(('else: ' if lines else '') + stmt)
+                break
+            lines.append('{} {}: {}'.format('elif' if lines else 'if', ' and '.join(parts), stmt))
+        return lines
+
+    def _compare(self, exps, a, b):
+        if exps[0][0] != GLOBAL and exps[0][0] != LOCAL:
+            return '{} == {}'.format(a, b) if exps[0][0] == CONST else 'cmp({}, {})'.format(a, b)
+        return '(cmp({0}, {1}) if {0}.__class__ in LIST_TYPES else {0} == {1})'.format(a, b)
+
+    def _gen(self, pc, ins):
+        if not ins:
+            return []
+        cmd = ins[0]
+        gen = getattr(self, '_gen_' + cmd.replace('/', '_'), None)
+        if gen is None:
+            return self._gen_fallback(pc, ins)
+        return gen(pc, ins)
+
+    def _gen_fallback(self, pc, ins):
+        handler = self.evaluator.dispatch.get(ins[0])
+        if handler is None:
+            return []
+        self.namespace['H{}'.format(pc)] = handler
+        self.namespace['I{}'.format(pc)] = ins
+        lines = [
+            'env[\'pc\'] = {}'.format(pc),
+            'H{0}(I{0}, env, None, None, P)'.format(pc),
+        ]
+        if ins[0] in self.evaluator.extended:
+            # extensions may jump
+            lines.append('if env[\'pc\'] != {0}: return env[\'pc\'] + 1'.format(pc))
+        return lines
+
+    def _operands(self, ins, first, count, ref=False):
+        lines = []
+        values = []
+        for i in range(count):
+            load, value = self._load(ins[first + i], 'v{}'.format(i), ref)
+            lines += load
+            values.append(value)
+        return lines, values
+
+    def _gen_let(self, pc, ins):
+        lines, (a,) = self._operands(ins, 2, 1, ref=True)
+        return lines + [self._store(ins[1], a)]
+
+    def _gen_add(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 2, 2)
+        ea, eb = ins[2], ins[3]
+        int_a, int_b = self._type_test(ea, a, int), self._type_test(eb, b, int)
+        str_a, str_b = self._type_test(ea, a, str), self._type_test(eb, b, str)
+        if 'True' in (str_a, str_b):
+            str_test = 'True'
+        else:
+            str_test = ' or '.join(t for t in (str_a, str_b) if t != 'False') or 'False'
+        return lines + self._branches([
+            ('{} and {}'.format(int_a, int_b), 'r = {} + {}'.format(a, b)),
+            ('{} and isnum({})'.format(self._type_test(ea, a, None), b), 'r = chr({})'.format(b)),
+            (str_test, 'r = str({}) + str({})'.format(a, b)),
+            ('True', 'r = {} + {}'.format(a, b)),
+        ]) + [self._store(ins[1], 'r')]
+
+    def _gen_sub(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 2, 2)
+        return lines + self._branches([
+            ('{} and {}'.format(self._type_test(ins[2], a, str), self._type_test(ins[3], b, None)),
+                'r = ord({})'.format(a)),
+            ('True', 'r = {} - {}'.format(a, b)),
+        ]) + [self._store(ins[1], 'r')]
+
+    def _gen_mul(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 2, 2)
+        return lines + self._branches([
+            ('{} and {} and {} > 0'.format(self._type_test(ins[2], a, str), self._type_test(ins[3], b, int), b),
+                'r = {} * {}'.format(a, b)),
+            ('True', 'r = int({}) * int({})'.format(a, b)),
+        ]) + [self._store(ins[1], 'r')]
+
+    def _gen_mod(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 2, 2)
+        return lines + [self._store(ins[1], '{} % {}'.format(a, b))]
+
+    def _gen_div(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 2, 2)
+        return lines + [self._store(ins[1], '{} // {}'.format(a, b))]
+
+    # === LIST / MAP ===
+    def _gen_len(self, pc, ins):
+        return self._load_var(ins[1], 'c') + [self._store(ins[2], 'len(c)')]
+
+    def _gen_get(self, pc, ins):
+        lines, (k,) = self._operands(ins, 2, 1)
+        return self._load_var(ins[1], 'c') + lines + [
+            'if c.__class__ is dict: r = c.get({})'.format(k),
+            'elif {0} < len(c): r = c[{0}]'.format(k),
+            'else: r = \'\' if c.__class__ is str or c.__class__ is Text else None',
+            self._store(ins[3], 'r'),
+        ]
+
+    def _gen_psh(self, pc, ins):
+        # lists inline, strings through the evaluator
+        lines = self._load_var(ins[1], 'c') + ['if c.__class__ is list:']
+        for exp in ins[2:]:
+            load, value = self._load(exp, 'v0', ref=True)
+            lines += ['    ' + line for line in load]
+            lines.append('    c.append({})'.format(value))
+        return lines + ['else:'] + ['    ' + line for line in self._gen_fallback(pc, ins)]
+
+    def _gen_put(self, pc, ins):
+        lines, (k, v) = self._operands(ins, 2, 2, ref=True)
+        return self._load_var(ins[1], 'c') + lines + [
+            'if c.__class__ is list or c.__class__ is dict: c[{}] = {}'.format(k, v),
+        ] + ['else:'] + ['    ' + line for line in self._gen_fallback(pc, ins)]
+
+    # === JUMP ===
+    def _gen_jmp(self, pc, ins):
+        return ['return {}'.format(ins[1] + 1)]
+
+    def _gen_jeq(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 1, 2)
+        return lines + ['if {}: return {}'.format(self._compare(ins[1:3], a, b), ins[3] + 1)]
+
+    def _gen_jne(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 1, 2)
+        return lines + ['if not {}: return {}'.format(self._compare(ins[1:3], a, b), ins[3] + 1)]
+
+    def _gen_jlt(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 1, 2)
+        return lines + ['if {} < {}: return {}'.format(a, b, ins[3] + 1)]
+
+    def _gen_jgt(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 1, 2)
+        return lines + ['if int({}) > int({}): return {}'.format(a, b, ins[3] + 1)]
+
+    def _gen_ife(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 1, 2)
+        return lines + ['if not {}: return {}'.format(self._compare(ins[1:3], a, b), ins[-1] + 1)]
+
+    def _gen_ifg(self, pc, ins):
+        lines, (a, b) = self._operands(ins, 1, 2)
+        return lines + ['if {} <= {}: return {}'.format(a, b, ins[-1] + 1)]
+
+    def _gen_els(self, pc, ins):
+        return ['return {}'.format(ins[-1] + 1)]
+
+    def _gen_fin(self, pc, ins):
+        return []
+
+    # === FUNC ===
+    def _gen_def(self, pc, ins):
+        return ['return {}'.format(ins[-1] + 1)]
+
+    def _gen_cal(self, pc, ins):
+        if ins[1][2] is None:
+            # lazy program, the function body is compiled now
+            ins = self.program.link(pc)
+            self._scan(ins[1][1], self.program[ins[1][1]][-1] + 1)
+        func_name, func_pc, slot_count, arg_slots = ins[1]
+        lines = ['slots = [UNSET] * {}'.format(slot_count)]
+        for i, slot in enumerate(arg_slots[:len(ins) - 2]):
+            load, value = self._load(ins[2 + i], 'v0', ref=True)
+            lines += load
+            lines.append('slots[{}] = {}'.format(slot, value))
+        return lines + [
+            'env[\'stack\'].append(Frame({!r}, {}, slots))'.format(func_name, pc),
+            'return {}'.format(func_pc + 1),
+        ]
+
+    def _gen_ret(self, pc, ins):
+        if len(ins) > 1:
+            lines, (value,) = self._operands(ins, 1, 1, ref=True)
+        else:
+            lines, value = [], 'None'
+        return lines + [
+            'stack = env[\'stack\']',
+            'frame = stack.pop()',
+            'if stack: stack[-1].slots[0] = {}'.format(value),
+            'else: G[\'ret\'] = {}'.format(value),
+            'return frame.pc + 1',
+        ]
+
+    def _gen_end(self, pc, ins):
+        return ['return env[\'stack\'].pop().pc + 1']
+
+    # === FOR LOOP ===
+    def _gen_for(self, pc, ins):
+        if self.in_func[pc]:
+            lines = [
+                'frame = env[\'stack\'][-1]',
+                'if frame.loops is None: frame.loops = {}',
+                'loops = frame.loops',
+            ]
+        else:
+            lines = ['loops = env[\'loops\']']
+        load, rg = self._load(ins[2], 'v0')
+        lines += [
+            'it = loops.get({})'.format(pc),
+            'if it is None:',
+        ] + ['    ' + line for line in load] + [
+            '    it = loops[{}] = loop_iter({})'.format(pc, rg),
+            'item = next(it, LOOP_END)',
+            'if item is LOOP_END:',
+            '    del loops[{}]'.format(pc),
+            '    return {}'.format(ins[-1] + 1),
+            self._store(ins[1], 'item'),
+        ]
+        return lines
+
+    def _gen_nxt(self, pc, ins):
+        return ['return {}'.format(ins[-1] + 1)]
+
+    # === SUPERINSTRUCTIONS ===
+    # same operand layout as the plain commands, constants are inlined anyway
+    _gen_let_k = _gen_let
+    _gen_jeq_k = _gen_jeq
+    _gen_jne_k = _gen_jne
+    _gen_jlt_k = _gen_jlt
+    _gen_jgt_k = _gen_jgt
+    _gen_ife_k = _gen_ife
+    _gen_ifg_k = _gen_ifg
+
+    def _gen_add_jmp(self, pc, ins):
+        return self._gen_add(pc, ins) + ['return {}'.format(ins[4] + 1)]
+
+def new_env():
+    return {
         'pc': 0,
         'stack': [],
         'global': {},
         'loops': {},
     }
 
-    with open(sys.argv[1], 'r') as src_file:
-        prog, lbls, funcs = parser.parse(src_file.read())
-        while env['pc'] < len(prog):
-            evaluator.eval(prog[env['pc']], env, lbls, funcs, prog)
-            env['pc'] += 1
\ No newline at end of file
+class VM:
+    # a compiled program with its own env, run in slices of instructions
+    def __init__(self, compiled, evaluator=None, name=''):
+        self.program, self.labels, self.funcs = compiled
+        self.evaluator = evaluator or Evaluator()
+        self.env = new_env()
+        self.name = name
+        self.instructions = 0  # executed so far
+        self.error = None      # exception that stopped the program, set by Scheduler
+        # env of the running task (spn), None after it was parked
+        self.current = self.env
+        # wait in time.sleep when all tasks sleep, else run() returns, see wake_time()
+        self.blocking = True
+
+    @property
+    def done(self):
+        # the program ends with its main task
+        return self.env['pc'] >= len(self.program)
+
+    def snapshot(self, path):
+        self.evaluator.snapshot(path, self.program, self.env, self.current, self.labels, self.funcs)
+
+    @classmethod
+    def restore(cls, path, evaluator=None, name=''):
+        # VM that goes on from a snapshot
+        evaluator = evaluator or Evaluator()
+        compiled, env, running = evaluator.restore(path)
+        vm = cls(compiled, evaluator, name)
+        vm.env = env
+        vm.current = running
+        return vm
+
+    def line(self):
+        # source line number of the instruction of the running task
+        env = self.current or self.env
+        return self.program.lines[min(env['pc'], len(self.program) - 1)] + 1
+
+    def wake_time(self):
+        # time.monotonic() when a task wakes, if all of them sleep
+        if self.current is None and 'tasks' in self.env:
+            return self.env['tasks'].wake_time()
+        return None
+
+    def step(self):
+        # run one instruction, False when the program has already ended
+        if self.done:
+            return False
+        self.run(1)
+        return True
+
+    def run(self, max_instructions=None):
+        # run until the program ends or max_instructions have run,
+        # returns the number of instructions run
+        prog, lbls, funcs = self.program, self.labels, self.funcs
+        evaluate = self.evaluator.eval
+        end = len(prog)
+        count = 0
+        try:
+            while True:
+                env = self.current
+                if env is None:
+                    env = self.current = self.env['tasks'].next(self.blocking)
+                    if env is None:
+                        break
+                try:
+                    while env['pc'] < end and count != max_instructions:
+                        evaluate(prog[env['pc']], env, lbls, funcs, prog)
+                        env['pc'] += 1
+                        count += 1
+                except Switch:
+                    self.current = None
+                    continue
+                tasks = env.get('tasks')
+                if env['pc'] < end:
+                    # out of budget, the next turn goes to another task
+                    if tasks is not None and tasks.ready:
+                        tasks.pause()
+                        self.current = None
+                    break
+                if env is self.env:
+                    break
+                tasks.finish()
+                self.current = None
+        finally:
+            self.instructions += count
+        return count
+
+class Scheduler:
+    # Round robin over VMs in one process. Every turn runs one VM for at most
+    # quantum instructions, so a long running script can't starve the others.
+    # A VM that raises is stopped with the exception in vm.error.
+    def __init__(self, quantum=1000):
+        self.quantum = quantum
+        self.ready = collections.deque()
+        self.finished = []
+
+    def add(self, vm):
+        self.ready.append(vm)
+        return vm
+
+    def step(self):
+        # one turn, False when there is nothing left to run
+        if not self.ready:
+            return False
+        vm = self.ready.popleft()
+        try:
+            vm.run(self.quantum)
+        except Exception as e:
+            vm.error = e
+        if vm.done or vm.error is not None:
+            self.finished.append(vm)
+        else:
+            self.ready.append(vm)
+        return bool(self.ready)
+
+    def run(self):
+        while self.step():
+            pass
+        return self.finished
+
+class Suspend(Exception):
+    # raised by a command to hand an awaitable to AsyncDriver, the pc stays on
+    # the command until it is done, then its result is assigned to var (if any)
+    def __init__(self, awaitable, var=None):
+        super().__init__()
+        self.awaitable = awaitable
+        self.var = var
+
+class AsyncDriver:
+    # Runs VMs as asyncio tasks. slp and inp become suspension points that
+    # await instead of blocking the thread, and every VM goes back to the
+    # event loop each quantum instructions, so scripts, display refreshes
+    # and other I/O interleave in one loop.
+    # read_line: coroutine function for inp, defaults to input() in an executor
+    # asyncio is imported where it is used, it adds a lot to the start up of
+    # programs that don't run async
+    def __init__(self, quantum=1000, read_line=None):
+        self.quantum = quantum
+        self.read_line = read_line or self._read_stdin
+
+    async def _read_stdin(self):
+        import asyncio
+        return await asyncio.get_running_loop().run_in_executor(None, input)
+
+    def _op_slp(self, evaluator, ts, env, lbl, fun, program):
+        if 'tasks' in env:
+            # parks the task, the VM returns when all of them sleep
+            return evaluator._op_slp(ts, env, lbl, fun, program)
+        import asyncio
+        raise Suspend(asyncio.sleep(evaluator.expr(env, ts[1]) / 1000))
+
+    def _op_inp(self, evaluator, ts, env, lbl, fun, program):
+        evaluator.flush()
+        raise Suspend(self.read_line(), ts[1])
+
+    async def run(self, vm):
+        # run a VM to the end, an exception stops it and is kept in vm.error
+        import asyncio
+        dispatch = vm.evaluator.dispatch
+        handlers = dispatch['slp'], dispatch['inp']
+        dispatch['slp'] = functools.partial(self._op_slp, vm.evaluator)
+        dispatch['inp'] = functools.partial(self._op_inp, vm.evaluator)
+        vm.blocking = False
+        try:
+            while not vm.done:
+                try:
+                    vm.run(self.quantum)
+                except Suspend as suspend:
+                    result = await suspend.awaitable
+                    env = vm.current
+                    if suspend.var is not None:
+                        vm.evaluator._assign(env, suspend.var, result)
+                    env['pc'] += 1
+                else:
+                    wake = vm.wake_time()
+                    await asyncio.sleep(0 if wake is None else max(wake - time.monotonic(), 0))
+        except Exception as e:
+            vm.error = e
+        finally:
+            dispatch['slp'], dispatch['inp'] = handlers
+            vm.blocking = True
+        return vm
+
+    async def run_all(self, vms):
+        import asyncio
+        return await asyncio.gather(*(self.run(vm) for vm in vms))
+
+def compile_source(src, optimize=True, lazy=False):
+    parser = Parser()
+    scanned = parser.scan(src) if lazy else None
+    if scanned is not None:
+        # only the top level is compiled, instructions keep their lines
+        prog, lbls, funcs, bodies = scanned
+        functions = {name: (def_ln, None, None) for name, def_ln in funcs.items()}
+        code = Compiler().compile(prog, lbls, funcs, 0, functions)
+        if optimize:
+            code = Optimizer().optimize(code, compact=False)
+        code = LazyCode(code, src.split('\n'), lbls, bodies, functions, optimize)
+        return code, lbls, funcs
+    prog, lbls, funcs = parser.parse(src)
+    code = Compiler().compile(prog, lbls, funcs)
+    if optimize:
+        code = Optimizer().optimize(code)
+    return code, lbls, funcs
+
+def cache_path(src_path):
+    return os.path.splitext(src_path)[0] + CACHE_EXT
+
+def _cache_key(data, optimize=True):
+    return '{} py{}.{} O{} {}'.format(VERSION, *sys.version_info[:2], int(optimize), hashlib.sha1(data).hexdigest())
+
+class _Unpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        # classes pickled with runtime.py run as a script or imported as a
+        # module are both this module's
+        if module in ('__main__', 'runtime'):
+            return globals()[name]
+        return super().find_class(module, name)
+
+def _read_cache(path, key):
+    try:
+        with open(path, 'rb') as cache_file:
+            cached = _Unpickler(cache_file).load()
+    except Exception:
+        return None
+    if type(cached) != dict or cached.get('key') != key:
+        return None
+    return cached['program'], cached['labels'], cached['funcs']
+
+def _write_cache(path, key, compiled):
+    prog, lbls, funcs = compiled
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump({
+                'key': key,
+                'program': prog,
+                'labels': lbls,
+                'funcs': funcs,
+            }, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except OSError:
+        # read-only location, run without cache
+        pass
+
+class _SnapshotPickler(pickle.Pickler):
+    # the _UNSET of unassigned slots is stored by name to keep its identity
+    def persistent_id(self, obj):
+        return 'unset' if obj is _UNSET else None
+
+class _SnapshotUnpickler(_Unpickler):
+    def persistent_load(self, pid):
+        return _UNSET
+
+def load_program(src_path, use_cache=True, optimize=True, lazy=False):
+    with open(src_path, 'rb') as src_file:
+        data = src_file.read()
+    if lazy:
+        # compiled on demand, nothing to cache
+        return compile_source(data.decode(), optimize, lazy)
+    key = _cache_key(data, optimize)
+    if use_cache:
+        cached = _read_cache(cache_path(src_path), key)
+        if cached is not None:
+            return cached
+    compiled = compile_source(data.decode(), optimize)
+    if use_cache:
+        _write_cache(cache_path(src_path), key, compiled)
+    return compiled
+
+def source_paths(paths):
+    # the given files, and every .runtime file under the given dirs
+    src_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                src_paths += [os.path.join(root, f) for f in sorted(files) if f.endswith('.runtime')]
+        else:
+            src_paths.append(path)
+    return src_paths
+
+def precompile(paths):
+    # compile every .runtime file under the given dirs, returns the number of failures
+    failed = 0
+    for src_path in source_paths(paths):
+        try:
+            load_program(src_path)
+            print('compiled', cache_path(src_path))
+        except CompileError as e:
+            failed += 1
+            print('failed', src_path)
+            print(e)
+    return failed
+
+def run_script(path, use_cache=True, optimize=True, engine='ref'):
+    # run one program with its prt output captured, the unit of work of run_batch
+    out = io.StringIO()
+    error = None
+    vm = None
+    start = time.perf_counter()
+    try:
+        vm = VM(load_program(path, use_cache, optimize), name=path)
+        with contextlib.redirect_stdout(out):
+            if engine == 'fast':
+                FastEvaluator(vm.evaluator, vm.program).run(vm.env)
+            else:
+                vm.run()
+    except CompileError as e:
+        error = str(e)
+    except Exception as e:
+        error = 'line {}: {!r}'.format(vm.line(), e) if vm else repr(e)
+    seconds = time.perf_counter() - start
+    output = out.getvalue()
+    passed = error is None
+    # test scripts end with a 'Failed <count>' line
+    failed_lines = [ln for ln in output.split('\n') if ln.startswith('Failed ')]
+    if passed and failed_lines:
+        passed = failed_lines[-1][len('Failed '):].strip() == '0'
+    return {
+        'path': path,
+        'passed': passed,
+        'seconds': round(seconds, 6),
+        'instructions': vm.instructions if vm is not None else 0,
+        'error': error,
+        'output': output,
+    }
+
+def run_batch(paths, jobs=None, use_cache=True, optimize=True, engine='ref'):
+    # run the scripts on a pool of worker processes, each worker imports the
+    # interpreter once and runs many of them; returns the summary
+    import concurrent.futures
+    src_paths = source_paths(paths)
+    start = time.perf_counter()
+    work = functools.partial(run_script, use_cache=use_cache, optimize=optimize, engine=engine)
+    with concurrent.futures.ProcessPoolExecutor(jobs) as pool:
+        results = list(pool.map(work, src_paths))
+    passed = sum(1 for res in results if res['passed'])
+    return {
+        'passed': passed,
+        'failed': len(results) - passed,
+        'seconds': round(time.perf_counter() - start, 6),
+        'scripts': results,
+    }
+
+class _StreamOutput:
+    # stdout of a script run by the server, sent to the client line by line
+    def __init__(self, conn):
+        self.conn = conn
+        self.pending = []
+
+    def write(self, text):
+        self.pending.append(text)
+        if '\n' in text:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            text = ''.join(self.pending)
+            self.pending = []
+            self.conn.sendall((json.dumps({'out': text}) + '\n').encode())
+
+class Server:
+    # Interpreter daemon: a pre-forked pool of warm worker processes accepting
+    # on one unix socket, so scripts run without Python startup and imports.
+    #
+    # A request is one JSON line {"path": ...} or {"source": ..., "name": ...}.
+    # The reply streams {"out": text} lines with the prt output and ends with
+    # {"exit": status, "error": message or null}.
+    # Every worker keeps its compiled programs by content hash.
+
+    PROGRAMS = 256  # compiled programs kept per worker
+
+    def __init__(self, path, workers=2, output_device=None, optimize=True, engine='ref'):
+        self.path = path
+        self.workers = workers
+        self.output_device = output_device
+        self.optimize = optimize
+        self.engine = engine
+        self.programs = {}
+        if output_device == 'oled':
+            # import the display (PIL) once, before forking
+            from oled import oled
+            # one process owns the panel, workers would each reset it and
+            # draw their own screen on it
+            self.workers = 1
+
+    def serve_forever(self):
+        import signal
+        import socket
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(64)
+        pids = set()
+        signal.signal(signal.SIGTERM, self._terminate)
+        try:
+            while True:
+                while len(pids) < self.workers:
+                    pid = os.fork()
+                    if pid == 0:
+                        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                        try:
+                            self._work(sock)
+                        finally:
+                            os._exit(0)
+                    pids.add(pid)
+                # a worker died, start a new one
+                pid, _ = os.wait()
+                pids.discard(pid)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in pids:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            sock.close()
+            os.unlink(self.path)
+
+    def _terminate(self, signum, frame):
+        # stop like on ctrl-c: workers are killed and the socket removed
+        raise KeyboardInterrupt()
+
+    def _work(self, sock):
+        while True:
+            conn, _ = sock.accept()
+            with conn:
+                try:
+                    self.handle(conn)
+                except OSError:
+                    # the client went away
+                    pass
+
+    def load(self, request):
+        if 'source' in request:
+            data = request['source'].encode()
+        else:
+            with open(request['path'], 'rb') as src_file:
+                data = src_file.read()
+        key = _cache_key(data, self.optimize)
+        compiled = self.programs.get(key)
+        if compiled is None:
+            compiled = compile_source(data.decode(), self.optimize)
+            if len(self.programs) >= self.PROGRAMS:
+                del self.programs[next(iter(self.programs))]
+            self.programs[key] = compiled
+        return compiled
+
+    def handle(self, conn):
+        request = json.loads(conn.makefile('rb').readline())
+        out = _StreamOutput(conn)
+        status, error = 0, None
+        vm = None
+        try:
+            vm = VM(self.load(request), Evaluator(output_device=self.output_device),
+                    name=request.get('path') or request.get('name', ''))
+            with contextlib.redirect_stdout(out):
+                if self.engine == 'fast':
+                    FastEvaluator(vm.evaluator, vm.program).run(vm.env)
+                else:
+                    vm.run()
+        except CompileError as e:
+            status, error = 1, str(e)
+        except (BrokenPipeError, ConnectionResetError):
+            raise
+        except Exception as e:
+            status, error = 1, 'line {}: {!r}'.format(vm.line(), e) if vm else repr(e)
+        if vm:
+            vm.evaluator.flush()
+        out.flush()
+        conn.sendall((json.dumps({'exit': status, 'error': error}) + '\n').encode())
+
+def run_many(paths, quantum=1000, output_device=None, use_cache=True, optimize=True, use_async=False):
+    # run the programs side by side in this process, returns the number of failures
+    vms = []
+    failed = 0
+    for path in paths:
+        try:
+            compiled = load_program(path, use_cache, optimize)
+        except CompileError as e:
+            failed += 1
+            print(e)
+            continue
+        vms.append(VM(compiled, Evaluator(output_device=output_device), name=path))
+    if use_async:
+        import asyncio
+        finished = asyncio.run(AsyncDriver(quantum).run_all(vms))
+    else:
+        scheduler = Scheduler(quantum)
+        for vm in vms:
+            scheduler.add(vm)
+        finished = scheduler.run()
+    for vm in finished:
+        vm.evaluator.flush()
+        if vm.error is not None:
+            failed += 1
+            print('ERR {} stopped at line {}: {!r}'.format(vm.name, vm.line(), vm.error))
+    return failed
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(
+        usage='python3 runtime.py <input_file> [<output-device>]')
+    arg_parser.add_argument('input_file', nargs='?')
+    arg_parser.add_argument('output_device', nargs='?')
+    arg_parser.add_argument('--no-cache', action='store_true',
+        help='do not read or write the compiled ' + CACHE_EXT + ' file')
+    arg_parser.add_argument('--compile', nargs='+', metavar='PATH',
+        help='precompile .runtime files (or dirs of them) and exit')
+    arg_parser.add_argument('--batch', nargs='+', metavar='PATH',
+        help='run .runtime files (or dirs of them) on a process pool, '
+             'print a JSON summary and exit')
+    arg_parser.add_argument('--jobs', type=int, metavar='N',
+        help='worker processes of --batch, default the number of CPUs')
+    arg_parser.add_argument('--serve', metavar='SOCKET',
+        help='run as a daemon on a unix socket, see runtime_client.py')
+    arg_parser.add_argument('--workers', type=int, default=2,
+        help='worker processes of --serve')
+    arg_parser.add_argument('--resume', metavar='SNAPSHOT',
+        help='go on from a snapshot written by snp instead of running a file')
+    arg_parser.add_argument('--run-many', nargs='+', metavar='FILE',
+        help='run several programs side by side in one process and exit')
+    arg_parser.add_argument('--quantum', type=int, default=1000,
+        help='instructions each program of --run-many runs per turn')
+    arg_parser.add_argument('--async', dest='use_async', action='store_true',
+        help='run on an asyncio event loop where slp and inp do not block')
+    arg_parser.add_argument('--no-optimize', action='store_true',
+        help='run the compiled program without the peephole optimizer')
+    arg_parser.add_argument('--lazy', action='store_true',
+        help='compile each function on its first call instead of the whole program up front')
+    arg_parser.add_argument('--engine', choices=('ref', 'fast'), default='ref',
+        help='ref: reference interpreter, fast: compile basic blocks to Python functions')
+    arg_parser.add_argument('--profile', nargs='?', const='', metavar='PREFIX',
+        help='write PREFIX.prof.txt and PREFIX.folded (flamegraph) at exit, '
+             'PREFIX defaults to the input file without extension')
+    args = arg_parser.parse_args()
+
+    if args.compile:
+        sys.exit(1 if precompile(args.compile) else 0)
+    if args.serve:
+        # python3 runtime.py --serve <socket> [<output-device>]
+        Server(args.serve, args.workers, args.input_file or args.output_device,
+               optimize=not args.no_optimize, engine=args.engine).serve_forever()
+        sys.exit(0)
+    if args.batch:
+        summary = run_batch(args.batch, args.jobs, use_cache=not args.no_cache,
+                            optimize=not args.no_optimize, engine=args.engine)
+        print(json.dumps(summary, indent=2))
+        sys.exit(1 if summary['failed'] else 0)
+    if args.run_many:
+        sys.exit(1 if run_many(args.run_many, args.quantum, args.output_device,
+                               use_cache=not args.no_cache, optimize=not args.no_optimize,
+                               use_async=args.use_async) else 0)
+    if args.resume:
+        # python3 runtime.py --resume <snapshot> [<output-device>]
+        args.output_device = args.output_device or args.input_file
+        args.input_file = None
+    elif args.input_file is None:
+        arg_parser.print_usage()
+        sys.exit(1)
+
+    profiler = Profiler() if args.profile is not None else None
+    evaluator = Evaluator(output_device=args.output_device, profiler=profiler)
+
+    if args.resume:
+        vm = VM.restore(args.resume, evaluator, name=args.resume)
+    else:
+        try:
+            compiled = load_program(args.input_file, use_cache=not args.no_cache,
+                                    optimize=not args.no_optimize, lazy=args.lazy)
+        except CompileError as e:
+            print(e)
+            sys.exit(1)
+        vm = VM(compiled, evaluator, name=args.input_file)
+    prog = vm.program
+    try:
+        if args.use_async:
+            import asyncio
+            asyncio.run(AsyncDriver().run(vm))
+            if vm.error is not None:
+                raise vm.error
+        elif args.engine == 'fast' and profiler is None:
+            FastEvaluator(evaluator, prog).run(vm.env, vm.current)
+        else:
+            vm.run()
+    except CompileError as e:
+        # a function of a lazy program compiled when first called
+        print(e)
+        sys.exit(1)
+    finally:
+        evaluator.flush()
+        if profiler is not None:
+            src_lines = None
+            if args.input_file:
+                with open(args.input_file) as src_file:
+                    src_lines = src_file.read().split('\n')
+            prefix = args.profile or os.path.splitext(args.input_file or args.resume)[0]
+            profiler.write(prefix, src_lines, prog.lines)
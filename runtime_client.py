@@ -0,0 +1,43 @@
+# Client of the interpreter daemon (python3 runtime.py --serve SOCKET)
+#
+#   python3 runtime_client.py SOCKET script.runtime
+#   python3 runtime_client.py SOCKET - < script.runtime
+#
+# Sends the script path, or the source read from stdin, streams the prt
+# output back and exits with the status of the script. Only imports what
+# it needs, so it starts much faster than runtime.py itself.
+
+import json
+import os
+import socket
+import sys
+
+
+def main():
+    if len(sys.argv) != 3:
+        print('usage: python3 runtime_client.py <socket> <input_file or ->', file=sys.stderr)
+        sys.exit(2)
+    sock_path, script = sys.argv[1:]
+    if script == '-':
+        request = {'source': sys.stdin.read(), 'name': '<stdin>'}
+    else:
+        request = {'path': os.path.abspath(script)}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(sock_path)
+    sock.sendall((json.dumps(request) + '\n').encode())
+    for line in sock.makefile('rb'):
+        msg = json.loads(line)
+        if 'out' in msg:
+            sys.stdout.write(msg['out'])
+            sys.stdout.flush()
+        elif 'exit' in msg:
+            if msg['error']:
+                print(msg['error'], file=sys.stderr)
+            sys.exit(msg['exit'])
+    print('connection closed by the server', file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()